@@ -1,164 +1,1032 @@
 # app.py
-from flask import Flask, render_template, redirect, url_for, request, session, jsonify
+import click
+from flask import Flask, render_template, redirect, url_for, request, session, jsonify, g, has_app_context, has_request_context, Response, stream_with_context
+import csv
+import hashlib
+import io
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 from werkzeug.security import generate_password_hash, check_password_hash
+from init_db import preparar_esquema
 
 app = Flask(__name__)
 app.secret_key = "clave_secreta_super_segura"
 
-DB_FILE = "pos.db"
+DB_FILE = os.environ.get("POS_DB", "pos.db")
 
 # ===== CONEXIÓN DB =====
-def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
+# Cada worker de gunicorn mantiene su propio pool; cada request toma una
+# conexión al primer uso (queda en g) y la devuelve en el teardown.
+DB_POOL_SIZE = 8
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 MB de caché de páginas
+    "PRAGMA mmap_size=268435456",    # 256 MB
+    "PRAGMA temp_store=MEMORY",
+)
+
+# ===== PERFIL SQL =====
+# Las conexiones del pool miden cada sentencia (execute/executemany; el
+# tiempo de los fetch posteriores no se cuenta). Se acumula por sentencia y
+# por endpoint, y las que pasan de SQL_LENTO_MS quedan en un registro con su
+# EXPLAIN QUERY PLAN. Se consulta en /ajustes/sql. Las listas de marcadores
+# (IN (?, ?, ...), VALUES (...), (...)) se colapsan para que una misma
+# sentencia con lotes de distinto tamaño cuente una sola vez, y pasadas
+# SQL_SENTENCIAS_MAX distintas las nuevas se suman en "(otras)".
+SQL_LENTO_MS = float(os.environ.get("POS_SQL_LENTO_MS", "100"))
+SQL_LENTAS_MAX = 200
+SQL_SENTENCIAS_MAX = 2000
+_RE_MARCADORES = re.compile(r"\?(?:\s*,\s*\?)+")
+_RE_FILAS = re.compile(r"(\([^()]*\))(?:\s*,\s*\1)+")
+_perfil_lock = threading.Lock()
+_perfil_sentencias = {}                 # sql -> [veces, total_ms, max_ms]
+_perfil_endpoints = {}                  # endpoint -> [requests, consultas, total_ms, max_consultas]
+_sql_lentas = deque(maxlen=SQL_LENTAS_MAX)
+
+def _registrar_sql(cur, sql, params, inicio):
+    ms = (time.perf_counter() - inicio) * 1000
+    texto = " ".join(sql.split())
+    if has_app_context():
+        g.sql_consultas = g.get("sql_consultas", 0) + 1
+        g.sql_ms = g.get("sql_ms", 0.0) + ms
+    clave = _RE_FILAS.sub(r"\1, ...", _RE_MARCADORES.sub("?, ...", texto))
+    with _perfil_lock:
+        if clave not in _perfil_sentencias and len(_perfil_sentencias) >= SQL_SENTENCIAS_MAX:
+            clave = "(otras)"
+        stats = _perfil_sentencias.setdefault(clave, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += ms
+        stats[2] = max(stats[2], ms)
+    if ms < SQL_LENTO_MS:
+        return
+    try:
+        plan = [row[3] for row in sqlite3.Cursor(cur.connection).execute("EXPLAIN QUERY PLAN " + sql, params)]
+    except sqlite3.Error:
+        plan = []
+    endpoint = request.endpoint if has_request_context() else None
+    _sql_lentas.append({"fecha": datetime.now().isoformat(timespec="seconds"), "endpoint": endpoint,
+                        "ms": round(ms, 2), "sql": texto, "plan": plan})
+    app.logger.warning("SQL lenta (%.1f ms) en %s: %s | plan: %s", ms, endpoint, texto, "; ".join(plan))
+
+class CursorPerfilado(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _registrar_sql(self, sql, params, inicio)
+
+    def executemany(self, sql, seq):
+        seq = seq if isinstance(seq, (list, tuple)) else list(seq)
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            _registrar_sql(self, sql, seq[0] if seq else (), inicio)
+
+class ConexionPool(sqlite3.Connection):
+    """Conexión del pool: close() no la cierra, el teardown la devuelve al pool."""
+
+    def cursor(self, factory=CursorPerfilado):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def close(self):
+        pass
+
+    def cerrar(self):
+        super().close()
+
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_pool_pid = os.getpid()
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+def _abrir_conexion(factory=sqlite3.Connection):
+    global _esquema_listo
+    conn = sqlite3.connect(DB_FILE, factory=factory, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    if not _esquema_listo:
+        # Primera conexión del proceso: tablas y migraciones pendientes
+        with _esquema_lock:
+            if not _esquema_listo:
+                preparar_esquema(conn)
+                _esquema_listo = True
+                if CONTABILIDAD_DIFERIDA:
+                    # Asientos que quedaron en cola de una ejecución anterior
+                    despertar_worker_asientos()
     return conn
 
-# =========================
-# FUNCIONES AUXILIARES CONTABILIDAD
-# =========================
-def crear_asiento_venta(factura_id):
+def _tomar_del_pool():
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        # Proceso hijo (fork de gunicorn): no reutilizar conexiones del padre
+        _pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        _pool_pid = os.getpid()
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        factura = cur.execute("SELECT numero, fecha, total FROM facturas WHERE id = ?", (factura_id,)).fetchone()
-        if not factura:
-            conn.close()
-            return
-        fecha = factura["fecha"]
-        total = factura["total"]
-        descripcion = f"Venta factura #{factura['numero']}"
-        caja = cur.execute("SELECT id FROM puc WHERE codigo = '1105'").fetchone()
-        ventas = cur.execute("SELECT id FROM puc WHERE codigo = '4135'").fetchone()
-        if caja and ventas:
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, ?, 0, 'ventas', ?)""",
-                        (fecha, caja["id"], descripcion, total, factura_id))
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, 0, ?, 'ventas', ?)""",
-                        (fecha, ventas["id"], descripcion, total, factura_id))
-        conn.commit()
-    except Exception as e:
-        print("Error creando asiento de venta:", e)
-    finally:
-        conn.close()
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _abrir_conexion(ConexionPool)
 
-def crear_asiento_compra(compra_id):
+def get_db_connection():
+    """Conexión del request actual; fuera de un request abre una conexión normal."""
+    if not has_app_context():
+        return _abrir_conexion()
+    if "db" not in g:
+        g.db = _tomar_del_pool()
+    return g.db
+
+@app.teardown_appcontext
+def devolver_conexion(exc):
+    conn = g.pop("db", None)
+    if conn is None:
+        return
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        compra = cur.execute("SELECT numero, fecha, total, forma_pago FROM compras WHERE id = ?", (compra_id,)).fetchone()
-        if not compra:
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.cerrar()
+
+@app.teardown_request
+def acumular_perfil_request(exc):
+    consultas = g.get("sql_consultas", 0)
+    if not consultas:
+        return
+    with _perfil_lock:
+        stats = _perfil_endpoints.setdefault(request.endpoint, [0, 0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += consultas
+        stats[2] += g.get("sql_ms", 0.0)
+        stats[3] = max(stats[3], consultas)
+
+@contextmanager
+def transaccion():
+    """Unidad de trabajo: todo lo escrito con el cursor se confirma en un solo commit.
+
+    Documento, líneas, inventario y asiento contable quedan juntos o no quedan.
+    Si la conexión ya tiene una transacción abierta (la de @idempotente), se
+    une a ella y el commit o rollback queda a cargo de quien la abrió.
+    """
+    propia = not has_app_context()
+    conn = get_db_connection()
+    anidada = conn.in_transaction
+    if not anidada:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+        if not anidada:
+            conn.commit()
+    except Exception:
+        if not anidada:
+            conn.rollback()
+        raise
+    finally:
+        if propia:
             conn.close()
-            return
-        fecha = compra["fecha"]
-        total = compra["total"]
-        descripcion = f"Compra #{compra['numero']}"
-        inventario = cur.execute("SELECT id FROM puc WHERE codigo = '1435'").fetchone()
-        if compra["forma_pago"] == "contado":
-            pago = cur.execute("SELECT id FROM puc WHERE codigo = '1105'").fetchone()
+
+# =========================
+# FUNCIONES AUXILIARES INVENTARIO
+# =========================
+STOCK_LOTE = 500  # productos por sentencia (4 parámetros cada uno)
+STOCK_TOLERANCIA = 1e-9  # margen para cantidades fraccionarias (0.3 - 0.1*3)
+
+class ConflictoStock(Exception):
+    """El documento pide más stock del disponible, o el producto cambió desde que se leyó.
+
+    conflictos: [{producto_id, nombre, solicitado, disponible, version}]
+    (solicitado es None cuando el conflicto es solo de versión).
+    """
+
+    def __init__(self, conflictos):
+        self.conflictos = conflictos
+        partes = [f"{c['nombre'] or c['producto_id']}: solicitado {c['solicitado']:g}, disponible {c['disponible']:g}"
+                  if c["solicitado"] is not None else
+                  f"{c['nombre'] or c['producto_id']}: modificado por otro usuario"
+                  for c in conflictos]
+        super().__init__("Conflicto de inventario (" + "; ".join(partes) + ")")
+
+    def respuesta(self):
+        return {"success": False, "error": str(self), "conflicto": True, "conflictos": self.conflictos}
+
+def conflictos_stock(cur, solicitados):
+    """Estado actual de los productos {producto_id: cantidad solicitada o None} para ConflictoStock."""
+    pids = list(solicitados)
+    marcas = ", ".join(["?"] * len(pids))
+    actuales = {r["id"]: r for r in
+                cur.execute(f"SELECT id, nombre, stock, version FROM productos WHERE id IN ({marcas})", pids)}
+    return [{"producto_id": pid, "nombre": actuales[pid]["nombre"] if pid in actuales else None,
+             "solicitado": cantidad, "disponible": float(actuales[pid]["stock"] or 0) if pid in actuales else 0.0,
+             "version": actuales[pid]["version"] if pid in actuales else None}
+            for pid, cantidad in solicitados.items()]
+
+def actualizar_stock(cur, deltas, costos=None, versiones=None):
+    """Suma a productos.stock los deltas {producto_id: cantidad}.
+
+    Una sola sentencia UPDATE ... FROM por cada STOCK_LOTE productos, sin
+    importar cuántas líneas tenga el documento. Si se pasa costos
+    {producto_id: costo}, también reemplaza el costo de esos productos.
+
+    La misma sentencia valida: un delta negativo solo se aplica si hay stock
+    suficiente, y con versiones {producto_id: version} solo si el producto no
+    cambió desde que se leyó. Cada fila aplicada sube su versión; si falta
+    alguna, lanza ConflictoStock (el llamador deshace el documento completo).
+    """
+    costos = costos or {}
+    versiones = versiones or {}
+    filas = [(pid, delta, costos.get(pid), versiones.get(pid)) for pid, delta in deltas.items()]
+    aplicados = set()
+    for i in range(0, len(filas), STOCK_LOTE):
+        lote = filas[i:i + STOCK_LOTE]
+        valores = ", ".join(["(?, ?, ?, ?)"] * len(lote))
+        aplicados.update(r[0] for r in cur.execute(f"""
+            WITH d(id, delta, costo, version) AS (VALUES {valores})
+            UPDATE productos
+            SET stock = stock + d.delta, costo = COALESCE(d.costo, productos.costo), version = productos.version + 1
+            FROM d
+            WHERE productos.id = d.id
+              AND (d.version IS NULL OR productos.version = d.version)
+              AND (d.delta >= 0 OR productos.stock >= -d.delta - {STOCK_TOLERANCIA})
+            RETURNING productos.id
+        """, [v for fila in lote for v in fila]).fetchall())
+    fallidos = {pid: (-delta if delta < 0 else None) for pid, delta in deltas.items() if pid not in aplicados}
+    if fallidos:
+        raise ConflictoStock(conflictos_stock(cur, fallidos))
+
+def registrar_kardex(cur, fecha, tipo, documento_id, movimientos):
+    """Aplica movimientos [(producto_id, cantidad, costo_unitario)] con costo promedio ponderado.
+
+    cantidad > 0 entra y < 0 sale. Las entradas con costo_unitario recalculan
+    el promedio; las salidas (y las entradas con costo None) se valoran al
+    promedio vigente. Cada movimiento deja su fila en kardex con los saldos
+    corridos, y productos queda con el stock y el costo promedio nuevos, así
+    que el costo y el valor del inventario se leen sin recorrer la historia.
+    Devuelve {producto_id: valor} (negativo en salidas): para una venta es
+    su costo de ventas. Una salida sin stock suficiente lanza ConflictoStock.
+    """
+    pids = list({int(pid) for pid, _, _ in movimientos})
+    saldos, versiones = {}, {}
+    for i in range(0, len(pids), STOCK_LOTE):
+        lote = pids[i:i + STOCK_LOTE]
+        marcas = ", ".join(["?"] * len(lote))
+        for prod in cur.execute(f"SELECT id, stock, costo, version FROM productos WHERE id IN ({marcas})", lote):
+            saldos[prod["id"]] = (float(prod["stock"] or 0), float(prod["costo"] or 0))
+            versiones[prod["id"]] = prod["version"]
+    iniciales = dict(saldos)
+
+    faltantes = defaultdict(float)
+    filas, valores = [], defaultdict(float)
+    for pid, cantidad, costo in movimientos:
+        pid, cantidad = int(pid), float(cantidad)
+        if pid not in saldos:
+            if cantidad < 0:
+                faltantes[pid] -= cantidad
+            continue
+        if not cantidad:
+            continue
+        stock, promedio = saldos[pid]
+        nuevo = stock + cantidad
+        if cantidad > 0 and costo is not None:
+            costo = float(costo)
+            valor = cantidad * costo
+            promedio = (stock * promedio + valor) / nuevo if stock > 0 else costo
         else:
-            pago = cur.execute("SELECT id FROM puc WHERE codigo = '2205'").fetchone()
-        if inventario and pago:
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, ?, 0, 'compras', ?)""",
-                        (fecha, inventario["id"], descripcion, total, compra_id))
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, 0, ?, 'compras', ?)""",
-                        (fecha, pago["id"], descripcion, total, compra_id))
-        conn.commit()
-    except Exception as e:
-        print("Error creando asiento de compra:", e)
-    finally:
-        conn.close()
+            costo = promedio
+            valor = cantidad * promedio
+        saldos[pid] = (nuevo, promedio)
+        valores[pid] += valor
+        filas.append((pid, fecha, tipo, documento_id, cantidad, costo, valor, nuevo, nuevo * promedio, promedio))
+
+    if faltantes:
+        # Salida de un producto que ya no existe: no hay nada disponible
+        raise ConflictoStock(conflictos_stock(cur, dict(faltantes)))
+    # Primero el stock (valida disponibilidad y versión), luego el kardex
+    actualizar_stock(cur, {pid: saldos[pid][0] - iniciales[pid][0] for pid in valores},
+                     {pid: saldos[pid][1] for pid in valores},
+                     {pid: versiones[pid] for pid in valores})
+    cur.executemany("""
+        INSERT INTO kardex (producto_id, fecha, tipo, documento_id, cantidad, costo_unitario, valor,
+                            saldo_cantidad, saldo_valor, costo_promedio)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, filas)
+    acumular_existencias(cur, fecha, [(f[0], f[4], f[6]) for f in filas])
+    return dict(valores)
+
+def fijar_saldos_kardex(cur, fecha, tipo, saldos):
+    """Deja en kardex saldos fijados a mano (alta de productos, ajustes, importación).
+
+    saldos: [(producto_id, stock, costo, stock_anterior, costo_anterior)].
+    """
+    filas = [(pid, fecha, tipo, stock - stock_ant, costo, stock * costo - stock_ant * costo_ant,
+              stock, stock * costo, costo)
+             for pid, stock, costo, stock_ant, costo_ant in saldos]
+    cur.executemany("""
+        INSERT INTO kardex (producto_id, fecha, tipo, cantidad, costo_unitario, valor,
+                            saldo_cantidad, saldo_valor, costo_promedio)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, filas)
+    acumular_existencias(cur, fecha, [(f[0], f[3], f[5]) for f in filas])
+
+def acumular_existencias(cur, fecha, movimientos):
+    """Lleva los movimientos [(producto_id, cantidad, valor)] a existencias_diarias.
+
+    Igual que acumular_saldos: crea la fila del día con el acumulado anterior
+    y suma a ella y a los días posteriores.
+    """
+    por_producto = defaultdict(lambda: [0.0, 0.0])
+    for pid, cantidad, valor in movimientos:
+        por_producto[pid][0] += cantidad
+        por_producto[pid][1] += valor
+    filas = [{"producto": pid, "fecha": fecha, "cantidad": cantidad, "valor": valor}
+             for pid, (cantidad, valor) in por_producto.items()]
+    cur.executemany("""
+        INSERT OR IGNORE INTO existencias_diarias (producto_id, fecha, cantidad_acum, valor_acum)
+        VALUES (:producto, :fecha,
+                IFNULL((SELECT cantidad_acum FROM existencias_diarias
+                        WHERE producto_id = :producto AND fecha < :fecha ORDER BY fecha DESC LIMIT 1), 0),
+                IFNULL((SELECT valor_acum FROM existencias_diarias
+                        WHERE producto_id = :producto AND fecha < :fecha ORDER BY fecha DESC LIMIT 1), 0))
+    """, filas)
+    cur.executemany("""
+        UPDATE existencias_diarias
+        SET cantidad = cantidad + CASE WHEN fecha = :fecha THEN :cantidad ELSE 0 END,
+            valor = valor + CASE WHEN fecha = :fecha THEN :valor ELSE 0 END,
+            cantidad_acum = cantidad_acum + :cantidad,
+            valor_acum = valor_acum + :valor
+        WHERE producto_id = :producto AND fecha >= :fecha
+    """, filas)
+
+def kardex_desde(cur):
+    """Primer día con la historia completa en kardex, o None si la tiene toda.
+
+    En una base que ya tenía documentos el kardex arrancó del stock del día
+    de la migración; antes de esa fecha no hay existencias que consultar.
+    """
+    row = cur.execute("SELECT valor FROM parametros WHERE nombre = 'kardex_desde'").fetchone()
+    return row["valor"] if row else None
+
+def sin_datos_kardex(desde):
+    return jsonify({"success": False, "error": f"Sin datos de inventario antes de {desde}", "desde": desde}), 422
+
+def existencias_al(cur, fecha, producto_id=None):
+    """Cantidad y valor de cada producto al cierre de `fecha` (una búsqueda por producto)."""
+    sql = """
+        SELECT p.id AS producto_id, p.nombre,
+               IFNULL(e.cantidad_acum, 0) AS cantidad, IFNULL(e.valor_acum, 0) AS valor
+        FROM productos p
+        LEFT JOIN existencias_diarias e ON e.producto_id = p.id
+             AND e.fecha = (SELECT MAX(fecha) FROM existencias_diarias
+                            WHERE producto_id = p.id AND fecha <= :fecha)
+    """
+    if producto_id is not None:
+        return cur.execute(sql + " WHERE p.id = :producto", {"fecha": fecha, "producto": producto_id}).fetchone()
+    return cur.execute(sql + " ORDER BY p.nombre", {"fecha": fecha}).fetchall()
 
-def crear_asiento_recibo(recibo_id):
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        recibo = cur.execute("SELECT numero, fecha, valor, concepto FROM recibos_caja WHERE id = ?", (recibo_id,)).fetchone()
-        if not recibo:
-            conn.close()
-            return
-        descripcion = f"Recibo de Caja #{recibo['numero']} - {recibo['concepto'] or ''}"
-        caja = cur.execute("SELECT id FROM puc WHERE codigo = '1105'").fetchone()
-        ingreso = cur.execute("SELECT id FROM puc WHERE codigo = '4199'").fetchone()  # Otros ingresos
-        if caja and ingreso:
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, ?, 0, 'recibo_caja', ?)""",
-                        (recibo["fecha"], caja["id"], descripcion, recibo["valor"], recibo_id))
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, 0, ?, 'recibo_caja', ?)""",
-                        (recibo["fecha"], ingreso["id"], descripcion, recibo["valor"], recibo_id))
-        conn.commit()
-    except Exception as e:
-        print("Error asiento recibo:", e)
-    finally:
-        conn.close()
+# =========================
+# FUNCIONES AUXILIARES RESÚMENES
+# =========================
+# Los resúmenes diarios se actualizan en la misma transacción que el
+# documento; las notas crédito restan (valores negativos, documentos=0).
+def _acumular_resumen_detalle(cur, tipo, dia, tercero_id, total, lineas, documentos):
+    por_producto = defaultdict(lambda: [0.0, 0.0])
+    for pid, cantidad, total_linea in lineas:
+        por_producto[int(pid)][0] += float(cantidad)
+        por_producto[int(pid)][1] += float(total_linea)
+    cur.executemany(f"""
+        INSERT INTO resumen_{tipo}_producto (fecha, producto_id, cantidad, total, num_documentos)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(fecha, producto_id) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            total = total + excluded.total,
+            num_documentos = num_documentos + excluded.num_documentos
+    """, [(dia, pid, cantidad, total_linea, documentos) for pid, (cantidad, total_linea) in por_producto.items()])
+    if tercero_id:
+        cur.execute(f"""
+            INSERT INTO resumen_{tipo}_tercero (fecha, tercero_id, num_documentos, total)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(fecha, tercero_id) DO UPDATE SET
+                num_documentos = num_documentos + excluded.num_documentos,
+                total = total + excluded.total
+        """, (dia, tercero_id, documentos, total))
+
+def acumular_resumen_venta(cur, fecha, tercero_id, total, lineas, documentos=1):
+    """Suma una factura a los resúmenes del día. lineas: [(producto_id, cantidad, total)]."""
+    dia = fecha[:10]
+    cur.execute("""
+        INSERT INTO resumen_ventas_dia (fecha, num_documentos, total) VALUES (?, ?, ?)
+        ON CONFLICT(fecha) DO UPDATE SET
+            num_documentos = num_documentos + excluded.num_documentos,
+            total = total + excluded.total
+    """, (dia, documentos, total))
+    _acumular_resumen_detalle(cur, "ventas", dia, tercero_id, total, lineas, documentos)
+
+def acumular_resumen_compra(cur, fecha, tercero_id, total, pagada, lineas):
+    """Suma una compra a los resúmenes del día. lineas: [(producto_id, cantidad, total)]."""
+    dia = fecha[:10]
+    cur.execute("""
+        INSERT INTO resumen_compras_dia (fecha, num_documentos, total, pagadas, pendientes)
+        VALUES (?, 1, ?, ?, ?)
+        ON CONFLICT(fecha) DO UPDATE SET
+            num_documentos = num_documentos + 1,
+            total = total + excluded.total,
+            pagadas = pagadas + excluded.pagadas,
+            pendientes = pendientes + excluded.pendientes
+    """, (dia, total, total if pagada else 0, 0 if pagada else total))
+    _acumular_resumen_detalle(cur, "compras", dia, tercero_id, total, lineas, 1)
+
+# =========================
+# FUNCIONES AUXILIARES CAJA
+# =========================
+# Cada documento suma a la sesión de caja abierta de quien lo registra, en
+# su misma transacción (una actualización por el índice parcial de sesiones
+# abiertas). Sin sesión abierta el documento se guarda igual, sin asignar.
+CAJA_CAMPOS = {
+    "venta": "ventas",
+    "recibo": "recibos",
+    "egreso": "egresos",
+    "devolucion": "devoluciones",
+    "compra_contado": "compras_contado",
+}
+# Efectivo que debería haber en la caja
+CAJA_ESPERADO = "base + ventas + recibos - egresos - devoluciones - compras_contado"
+
+def acumular_caja(cur, tipo, valor):
+    """Suma `valor` al total `tipo` de la sesión abierta del usuario. Devuelve su id o None."""
+    if not has_request_context() or "user" not in session:
+        return None
+    campo = CAJA_CAMPOS[tipo]
+    row = cur.execute(f"""
+        UPDATE sesiones_caja SET {campo} = {campo} + ?, num_{campo} = num_{campo} + 1
+        WHERE usuario = ? AND cerrada IS NULL
+        RETURNING id
+    """, (float(valor), session["user"])).fetchone()
+    return row["id"] if row else None
 
-def crear_asiento_egreso(egreso_id):
+# =========================
+# FUNCIONES AUXILIARES CONTABILIDAD
+# =========================
+# Caché codigo -> id del PUC, compartida por todo el proceso. Las cuentas
+# no se borran ni cambian de código, así que solo hay que recargarla cuando
+# se agregan (add_cuenta, seed_puc) o cuando se pide un código desconocido,
+# que puede haber sido creado por otro worker.
+_puc_cache = {}
+_puc_lock = threading.Lock()
+
+def invalidar_cache_puc():
+    with _puc_lock:
+        _puc_cache.clear()
+
+def _recargar_cache_puc(cur):
+    cuentas = {row["codigo"]: row["id"] for row in cur.execute("SELECT codigo, id FROM puc")}
+    with _puc_lock:
+        _puc_cache.clear()
+        _puc_cache.update(cuentas)
+
+def cuentas_puc(cur, codigos):
+    """Devuelve {codigo: id} para los códigos pedidos, o None si falta alguno."""
+    if any(codigo not in _puc_cache for codigo in codigos):
+        _recargar_cache_puc(cur)
     try:
+        return {codigo: _puc_cache[codigo] for codigo in codigos}
+    except KeyError:
+        return None
+
+def acumular_saldos(cur, fecha, movimientos):
+    """Lleva los movimientos [(cuenta_id, debito, credito)] a saldos_diarios.
+
+    Crea la fila del día con los acumulados del día anterior y suma a ella y
+    a los días posteriores (solo existen si el asiento es de fecha pasada).
+    """
+    por_cuenta = defaultdict(lambda: [0.0, 0.0])
+    for cuenta_id, debito, credito in movimientos:
+        por_cuenta[cuenta_id][0] += debito or 0
+        por_cuenta[cuenta_id][1] += credito or 0
+    filas = [{"cuenta": cuenta_id, "fecha": fecha, "debito": debito, "credito": credito}
+             for cuenta_id, (debito, credito) in por_cuenta.items()]
+    cur.executemany("""
+        INSERT OR IGNORE INTO saldos_diarios (cuenta_id, fecha, debito_acum, credito_acum)
+        VALUES (:cuenta, :fecha,
+                IFNULL((SELECT debito_acum FROM saldos_diarios
+                        WHERE cuenta_id = :cuenta AND fecha < :fecha ORDER BY fecha DESC LIMIT 1), 0),
+                IFNULL((SELECT credito_acum FROM saldos_diarios
+                        WHERE cuenta_id = :cuenta AND fecha < :fecha ORDER BY fecha DESC LIMIT 1), 0))
+    """, filas)
+    cur.executemany("""
+        UPDATE saldos_diarios
+        SET debito = debito + CASE WHEN fecha = :fecha THEN :debito ELSE 0 END,
+            credito = credito + CASE WHEN fecha = :fecha THEN :credito ELSE 0 END,
+            debito_acum = debito_acum + :debito,
+            credito_acum = credito_acum + :credito
+        WHERE cuenta_id = :cuenta AND fecha >= :fecha
+    """, filas)
+
+def registrar_asiento(cur, fecha, descripcion, modulo, referencia_id, partidas):
+    """Inserta un asiento con partidas [(codigo_puc, debito, credito)].
+
+    Si alguna cuenta no existe en el PUC no se registra nada. Los saldos
+    diarios se actualizan en la misma transacción.
+    """
+    cuentas = cuentas_puc(cur, {codigo for codigo, _, _ in partidas})
+    if cuentas is None:
+        return False
+    movimientos = [(cuentas[codigo], debito, credito) for codigo, debito, credito in partidas]
+    cur.executemany("""INSERT INTO movimientos_contables
+                       (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    [(fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
+                     for cuenta_id, debito, credito in movimientos])
+    acumular_saldos(cur, fecha, movimientos)
+    return True
+
+def crear_asiento_venta(cur, factura_id, numero, fecha, total):
+    return registrar_asiento(cur, fecha, f"Venta factura #{numero}", "ventas", factura_id,
+                      [("1105", total, 0),    # Caja
+                       ("4135", 0, total)])   # Ventas
+
+def crear_asiento_compra(cur, compra_id, numero, fecha, total, forma_pago):
+    pago = "1105" if forma_pago == "contado" else "2205"  # Caja / Proveedores
+    return registrar_asiento(cur, fecha, f"Compra #{numero}", "compras", compra_id,
+                      [("1435", total, 0),    # Inventario
+                       (pago, 0, total)])
+
+def crear_asiento_recibo(cur, recibo_id, numero, fecha, valor, concepto):
+    return registrar_asiento(cur, fecha, f"Recibo de Caja #{numero} - {concepto or ''}", "recibo_caja", recibo_id,
+                      [("1105", valor, 0),    # Caja
+                       ("4199", 0, valor)])   # Otros ingresos
+
+def crear_asiento_egreso(cur, egreso_id, numero, fecha, valor, concepto):
+    return registrar_asiento(cur, fecha, f"Comprobante Egreso #{numero} - {concepto or ''}", "egreso", egreso_id,
+                      [("5195", valor, 0),    # Gastos varios
+                       ("1105", 0, valor)])   # Caja
+
+def crear_asiento_nota_credito(cur, nota_id, numero, fecha, total):
+    return registrar_asiento(cur, fecha, f"Nota Crédito #{numero}", "notas_credito", nota_id,
+                      [("4135", total, 0),    # Disminuye ventas
+                       ("4175", 0, total)])   # Reconoce devolución
+
+def crear_asiento_transformacion(cur, trans_id, numero, fecha, total_entrada, total_salida):
+    # 1435 contra 1435: entra el producto transformado, sale la materia prima
+    return registrar_asiento(cur, fecha, f"Transformación {numero}", "transformacion", trans_id,
+                      [("1435", total_entrada, 0),
+                       ("1435", 0, total_salida)])
+
+def crear_asiento_costo_venta(cur, factura_id, numero, fecha, costo):
+    return registrar_asiento(cur, fecha, f"Costo de venta factura #{numero}", "costo_ventas", factura_id,
+                             [("6135", costo, 0),    # Costo de ventas
+                              ("1435", 0, costo)])   # Inventario
+
+def crear_asiento_costo_devolucion(cur, nota_id, numero, fecha, costo):
+    return registrar_asiento(cur, fecha, f"Costo devolución nota crédito #{numero}", "costo_devoluciones", nota_id,
+                             [("1435", costo, 0),
+                              ("6135", 0, costo)])
+
+# =========================
+# CONTABILIDAD DIFERIDA (cola de asientos)
+# =========================
+# Con POS_CONTABILIDAD_DIFERIDA=1 los documentos no registran su asiento:
+# dejan un trabajo en asientos_pendientes dentro de su misma transacción y
+# un hilo de fondo los pasa a movimientos_contables por lotes. Así el cobro
+# no espera a la contabilidad; los saldos quedan atrasados lo que indique
+# /api/contabilidad/pendientes.
+CONTABILIDAD_DIFERIDA = os.environ.get("POS_CONTABILIDAD_DIFERIDA") == "1"
+ASIENTOS_LOTE = 100
+ASIENTOS_INTERVALO = 2.0     # segundos entre revisiones de la cola
+ASIENTOS_MAX_INTENTOS = 5
+
+# tipo -> (función que registra el asiento, módulo con que queda en movimientos_contables)
+ASIENTOS = {
+    "venta": (crear_asiento_venta, "ventas"),
+    "compra": (crear_asiento_compra, "compras"),
+    "recibo": (crear_asiento_recibo, "recibo_caja"),
+    "egreso": (crear_asiento_egreso, "egreso"),
+    "nota_credito": (crear_asiento_nota_credito, "notas_credito"),
+    "transformacion": (crear_asiento_transformacion, "transformacion"),
+    "costo_venta": (crear_asiento_costo_venta, "costo_ventas"),
+    "costo_devolucion": (crear_asiento_costo_devolucion, "costo_devoluciones"),
+}
+
+_worker_asientos_pid = None
+_worker_asientos_lock = threading.Lock()
+_worker_asientos_evento = threading.Event()
+
+def contabilizar(cur, tipo, referencia_id, *args):
+    """Registra el asiento del documento, o lo encola si la contabilidad es diferida."""
+    funcion, modulo = ASIENTOS[tipo]
+    if not CONTABILIDAD_DIFERIDA:
+        return funcion(cur, referencia_id, *args)
+    cur.execute("INSERT INTO asientos_pendientes (tipo, modulo, referencia_id, datos) VALUES (?, ?, ?, ?)",
+                (tipo, modulo, referencia_id, json.dumps(args)))
+    despertar_worker_asientos()
+    return True
+
+def procesar_asientos_pendientes(lote=ASIENTOS_LOTE):
+    """Pasa un lote de la cola a movimientos_contables. Devuelve (registrados, leidos).
+
+    Cada trabajo va en su propio savepoint: uno que falla suma un intento,
+    guarda el error y se reintenta más tarde, sin deshacer los demás. Si el documento ya tiene
+    movimientos con su (modulo, referencia_id) solo se saca de la cola.
+    """
+    registrados = 0
+    with transaccion() as cur:
+        trabajos = cur.execute("""
+            SELECT id, tipo, modulo, referencia_id, datos FROM asientos_pendientes
+            WHERE intentos < ? AND proximo_intento <= datetime('now')
+            ORDER BY id LIMIT ?
+        """, (ASIENTOS_MAX_INTENTOS, lote)).fetchall()
+        for t in trabajos:
+            cur.execute("SAVEPOINT asiento")
+            try:
+                ya = cur.execute("SELECT 1 FROM movimientos_contables WHERE modulo = ? AND referencia_id = ? LIMIT 1",
+                                 (t["modulo"], t["referencia_id"])).fetchone()
+                if not ya and not ASIENTOS[t["tipo"]][0](cur, t["referencia_id"], *json.loads(t["datos"])):
+                    raise ValueError("Faltan cuentas en el PUC")
+                cur.execute("DELETE FROM asientos_pendientes WHERE id = ?", (t["id"],))
+                cur.execute("RELEASE asiento")
+                registrados += 1
+            except Exception as e:
+                cur.execute("ROLLBACK TO asiento")
+                cur.execute("RELEASE asiento")
+                # Espera creciente: 30 s, 1 min, 2 min, 4 min...
+                cur.execute("""
+                    UPDATE asientos_pendientes
+                    SET intentos = intentos + 1, error = ?,
+                        proximo_intento = datetime('now', '+' || (30 << intentos) || ' seconds')
+                    WHERE id = ?
+                """, (str(e), t["id"]))
+    return registrados, len(trabajos)
+
+def _bucle_asientos():
+    while True:
+        _worker_asientos_evento.wait(ASIENTOS_INTERVALO)
+        _worker_asientos_evento.clear()
+        try:
+            while True:
+                registrados, leidos = procesar_asientos_pendientes()
+                if leidos < ASIENTOS_LOTE or registrados == 0:
+                    break
+        except Exception as e:
+            print("Error en worker de asientos:", e)
+
+def despertar_worker_asientos():
+    """Arranca el hilo de la cola en este proceso (una vez por worker) y lo despierta."""
+    global _worker_asientos_pid
+    if _worker_asientos_pid != os.getpid():
+        with _worker_asientos_lock:
+            if _worker_asientos_pid != os.getpid():
+                threading.Thread(target=_bucle_asientos, name="asientos", daemon=True).start()
+                _worker_asientos_pid = os.getpid()
+    _worker_asientos_evento.set()
+
+@app.cli.command("contabilizar-pendientes")
+def contabilizar_pendientes_cmd():
+    """Vacía la cola de asientos pendientes (para correrlo como proceso aparte)."""
+    total = 0
+    while True:
+        registrados, leidos = procesar_asientos_pendientes()
+        total += registrados
+        if leidos < ASIENTOS_LOTE or registrados == 0:
+            break
+    print(f"Asientos registrados: {total}")
+
+# =========================
+# COSTO DE VENTAS
+# =========================
+# El kardex ya valora cada salida al costo promedio, así que el costo de una
+# factura sale de registrar_kardex sin trabajo extra. Con
+# POS_COSTO_VENTAS=inline (por defecto) cada factura y nota crédito lleva su
+# asiento 6135/1435. Con POS_COSTO_VENTAS=diario no se contabiliza al
+# facturar: contabilizar_costo_ventas() (flask contabilizar-costo-ventas, por
+# cron) toma las filas de kardex nuevas desde la última corrida y registra un
+# asiento neto por día.
+COSTO_VENTAS_MODO = os.environ.get("POS_COSTO_VENTAS", "inline")
+
+def contabilizar_costo(cur, tipo, documento_id, numero, fecha, valores):
+    """Asiento de costo de un documento a partir de lo que devolvió registrar_kardex.
+
+    Si faltan 6135/1435 en el PUC el documento se guarda igual (como con su
+    asiento principal), pero queda el aviso en el log.
+    """
+    costo = abs(sum(valores.values()))
+    if COSTO_VENTAS_MODO == "inline" and costo:
+        if not contabilizar(cur, tipo, documento_id, numero, fecha, costo):
+            app.logger.warning("Costo de %s #%s (%.2f) sin contabilizar: faltan las cuentas 6135/1435 en el PUC",
+                               tipo, numero, costo)
+
+def contabilizar_costo_ventas():
+    """Registra el costo de ventas neto por día de las filas de kardex aún no contabilizadas.
+
+    La marca de agua (último kardex.id procesado) está en secuencias y se
+    mueve en la misma transacción que los asientos, así que correrlo dos
+    veces no duplica nada; los documentos contabilizados en modo inline se
+    saltan. Devuelve {fecha: costo}.
+    """
+    with transaccion() as cur:
+        desde = cur.execute("SELECT ultimo FROM secuencias WHERE nombre = 'costo_ventas_kardex'").fetchone()
+        desde = desde["ultimo"] if desde else 0
+        hasta = cur.execute("SELECT IFNULL(MAX(id), 0) AS id FROM kardex").fetchone()["id"]
+        if hasta <= desde:
+            return {}
+        dias = cur.execute("""
+            WITH t(tipo, modulo) AS (VALUES ('venta', 'costo_ventas'), ('nota_credito', 'costo_devoluciones'))
+            SELECT k.fecha, -SUM(k.valor) AS costo
+            FROM kardex k
+            JOIN t ON t.tipo = k.tipo
+            WHERE k.id > ? AND k.id <= ?
+              -- documentos que ya tienen (o tienen en cola) su asiento inline
+              AND NOT EXISTS (SELECT 1 FROM movimientos_contables m
+                              WHERE m.modulo = t.modulo AND m.referencia_id = k.documento_id)
+              AND NOT EXISTS (SELECT 1 FROM asientos_pendientes a
+                              WHERE a.modulo = t.modulo AND a.referencia_id = k.documento_id)
+            GROUP BY k.fecha ORDER BY k.fecha
+        """, (desde, hasta)).fetchall()
+        for dia in dias:
+            costo = round(dia["costo"], 2)
+            if costo > 0:
+                partidas = [("6135", costo, 0), ("1435", 0, costo)]
+            elif costo < 0:
+                partidas = [("1435", -costo, 0), ("6135", 0, -costo)]
+            else:
+                continue
+            if not registrar_asiento(cur, dia["fecha"], f"Costo de ventas del {dia['fecha']}",
+                                     "costo_ventas_dia", hasta, partidas):
+                raise ValueError("Faltan las cuentas 6135/1435 en el PUC")
+        cur.execute("""
+            INSERT INTO secuencias (nombre, ultimo) VALUES ('costo_ventas_kardex', ?)
+            ON CONFLICT(nombre) DO UPDATE SET ultimo = excluded.ultimo
+        """, (hasta,))
+    return {dia["fecha"]: dia["costo"] for dia in dias}
+
+@app.cli.command("contabilizar-costo-ventas")
+def contabilizar_costo_ventas_cmd():
+    """Asiento diario de costo de ventas (modo POS_COSTO_VENTAS=diario)."""
+    for fecha, costo in contabilizar_costo_ventas().items():
+        print(f"{fecha}: {costo:,.2f}")
+
+# =========================
+# NUMERACIÓN DE DOCUMENTOS
+# =========================
+# Los consecutivos salen de la tabla secuencias. El número definitivo se
+# toma dentro de la transacción que guarda el documento (BEGIN IMMEDIATE),
+# así dos cajas nunca reciben el mismo; el que se muestra en el formulario
+# es solo una referencia.
+def reservar_numeros(cur, nombre, cantidad=1):
+    """Reserva `cantidad` números consecutivos y devuelve (primero, ultimo)."""
+    row = cur.execute("UPDATE secuencias SET ultimo = ultimo + ? WHERE nombre = ? RETURNING ultimo",
+                      (cantidad, nombre)).fetchone()
+    if row is None:
+        raise ValueError(f"Secuencia desconocida: {nombre}")
+    return row["ultimo"] - cantidad + 1, row["ultimo"]
+
+def siguiente_numero(cur, nombre):
+    return reservar_numeros(cur, nombre)[0]
+
+def proximo_numero(cur, nombre):
+    """Número que probablemente tendrá el próximo documento (solo para mostrar)."""
+    row = cur.execute("SELECT ultimo FROM secuencias WHERE nombre = ?", (nombre,)).fetchone()
+    return (row["ultimo"] if row else 0) + 1
+
+# =========================
+# IDEMPOTENCIA (cabecera Idempotency-Key en los guardados de documentos)
+# =========================
+# La clave y la respuesta se guardan en la misma transacción que el
+# documento. Un reintento la encuentra con una búsqueda por clave primaria
+# (clave, usuario) y recibe la respuesta original sin pasar por la escritura;
+# un doble clic espera el lock de escritura del primero y al tomarlo ya la
+# encuentra. La clave reusada con otro cuerpo o en otra ruta se rechaza (422).
+# Solo se guardan respuestas exitosas: tras un error se puede reintentar
+# con la misma clave. Las claves vencen a los IDEMPOTENCIA_TTL segundos.
+IDEMPOTENCIA_TTL = int(os.environ.get("POS_IDEMPOTENCIA_TTL", 24 * 3600))
+IDEMPOTENCIA_PURGA = 300  # segundos entre purgas de claves vencidas (por proceso)
+_idempotencia_purga = 0.0
+
+def _respuesta_guardada(cur, clave, usuario):
+    return cur.execute("""
+        SELECT ruta, huella, status, respuesta FROM claves_idempotencia
+        WHERE clave = ? AND usuario = ? AND creado >= datetime('now', ?)
+    """, (clave, usuario, f"-{IDEMPOTENCIA_TTL} seconds")).fetchone()
+
+def _huella_cuerpo():
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+def _repetir_respuesta(row, huella):
+    if row["ruta"] != request.path:
+        return jsonify({"success": False, "error": "Idempotency-Key ya usada en otra operación"}), 422
+    if row["huella"] != huella:
+        return jsonify({"success": False, "error": "Idempotency-Key ya usada con otros datos"}), 422
+    return Response(row["respuesta"], status=row["status"], mimetype="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+def purgar_claves_idempotencia(cur):
+    cur.execute("DELETE FROM claves_idempotencia WHERE creado < datetime('now', ?)",
+                (f"-{IDEMPOTENCIA_TTL} seconds",))
+    return cur.rowcount
+
+def idempotente(vista):
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        global _idempotencia_purga
+        clave = request.headers.get("Idempotency-Key", "").strip()
+        if not clave or "user" not in session:
+            return vista(*args, **kwargs)
+        if len(clave) > 255:
+            return jsonify({"success": False, "error": "Idempotency-Key demasiado larga"}), 400
+        usuario = session["user"]
+        huella = _huella_cuerpo()
         conn = get_db_connection()
         cur = conn.cursor()
-        egreso = cur.execute("SELECT numero, fecha, valor, concepto FROM comprobantes_egreso WHERE id = ?", (egreso_id,)).fetchone()
-        if not egreso:
-            conn.close()
-            return
-        descripcion = f"Comprobante Egreso #{egreso['numero']} - {egreso['concepto'] or ''}"
-        caja = cur.execute("SELECT id FROM puc WHERE codigo = '1105'").fetchone()
-        gasto = cur.execute("SELECT id FROM puc WHERE codigo = '5195'").fetchone()  # Gastos varios
-        if caja and gasto:
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, ?, 0, 'egreso', ?)""",
-                        (egreso["fecha"], gasto["id"], descripcion, egreso["valor"], egreso_id))
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, 0, ?, 'egreso', ?)""",
-                        (egreso["fecha"], caja["id"], descripcion, egreso["valor"], egreso_id))
-        conn.commit()
-    except Exception as e:
-        print("Error asiento egreso:", e)
-    finally:
-        conn.close()
+        row = _respuesta_guardada(cur, clave, usuario)
+        if row:
+            return _repetir_respuesta(row, huella)
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Otro request con la misma clave pudo terminar mientras se esperaba el lock
+            row = _respuesta_guardada(cur, clave, usuario)
+            if row:
+                conn.rollback()
+                return _repetir_respuesta(row, huella)
+            resp = app.make_response(vista(*args, **kwargs))
+            if resp.status_code >= 400 or not (resp.get_json(silent=True) or {}).get("success"):
+                conn.rollback()
+                return resp
+            cur.execute("""
+                INSERT OR REPLACE INTO claves_idempotencia (clave, usuario, ruta, huella, status, respuesta)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (clave, usuario, request.path, huella, resp.status_code, resp.get_data(as_text=True)))
+            if time.time() - _idempotencia_purga > IDEMPOTENCIA_PURGA:
+                purgar_claves_idempotencia(cur)
+                _idempotencia_purga = time.time()
+            conn.commit()
+            return resp
+        except Exception:
+            conn.rollback()
+            raise
+    return envoltura
+
+# =========================
+# CATÁLOGOS CON VERSIÓN (productos, puc, terceros)
+# =========================
+# Cada escritura sube versiones_catalogo en su misma transacción. Las
+# lecturas comparan esa versión (una búsqueda por clave primaria) con la de
+# la caché del proceso y con el ETag del cliente, y solo consultan y
+# serializan de nuevo cuando cambió.
+_catalogo_cache = {}
+_catalogo_lock = threading.Lock()
+
+def tocar_catalogo(cur, *nombres):
+    cur.executemany("UPDATE versiones_catalogo SET version = version + 1 WHERE nombre = ?",
+                    [(nombre,) for nombre in nombres])
+
+def version_catalogo(cur, nombre):
+    row = cur.execute("SELECT version FROM versiones_catalogo WHERE nombre = ?", (nombre,)).fetchone()
+    return row["version"] if row else 0
+
+def leer_catalogo(cur, nombre, clave, construir, version=None):
+    """Filas del catálogo desde la caché, reconstruidas con construir(cur) si cambió la versión.
+
+    Devuelve (version, filas, cuerpo_json).
+    """
+    if version is None:
+        version = version_catalogo(cur, nombre)
+    entrada = _catalogo_cache.get((nombre, clave))
+    if entrada is None or entrada[0] != version:
+        filas = construir(cur)
+        entrada = (version, filas, json.dumps(filas, ensure_ascii=False))
+        with _catalogo_lock:
+            _catalogo_cache[(nombre, clave)] = entrada
+    return entrada
+
+def respuesta_catalogo(nombre, clave, construir):
+    """JSON del catálogo con ETag; responde 304 si el cliente ya tiene la versión."""
+    cur = get_db_connection().cursor()
+    version = version_catalogo(cur, nombre)
+    etag = f"{nombre}-{clave}-{version}"
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        _, _, cuerpo = leer_catalogo(cur, nombre, clave, construir, version)
+        resp = Response(cuerpo, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def _terceros(tipo=None):
+    def construir(cur):
+        sql = "SELECT id, nombres || ' ' || IFNULL(apellidos,'') as nombre FROM terceros"
+        rows = cur.execute(sql + " WHERE tipo = ?", (tipo,)) if tipo else cur.execute(sql)
+        return [dict(r) for r in rows]
+    return construir
+
+def terceros_catalogo(cur, tipo=None):
+    return leer_catalogo(cur, "terceros", tipo or "todos", _terceros(tipo))[1]
+
+def _cuentas_puc(cur):
+    return [dict(r) for r in cur.execute("SELECT codigo, nombre, tipo FROM puc ORDER BY codigo")]
+
+def _productos_todos(cur):
+    return [dict(p) for p in cur.execute("SELECT id, nombre, stock, costo, precio, stock_minimo, version FROM productos ORDER BY nombre")]
 
-def crear_asiento_nota_credito(nota_id):
+# =========================
+# LISTAS PAGINADAS (keyset sobre fecha DESC, id DESC)
+# =========================
+LISTA_LIMITE = 200
+LISTA_LIMITE_MAX = 1000
+
+def leer_pagina(data):
+    """Lee after=[fecha, id] (o "fecha,id") y limit. Devuelve (after, limite).
+
+    Un after o un limit mal formados no son error: se lee desde la primera
+    página o con el límite por defecto.
+    """
+    after = data.get("after")
+    if isinstance(after, str):
+        after = after.rsplit(",", 1) if after else None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        nota = cur.execute("SELECT numero, fecha, total FROM notas_credito WHERE id = ?", (nota_id,)).fetchone()
-        if not nota:
-            conn.close()
-            return
-        fecha = nota["fecha"]
-        total = nota["total"]
-        descripcion = f"Nota Crédito #{nota['numero']}"
-        ventas = cur.execute("SELECT id FROM puc WHERE codigo = '4135'").fetchone()  # Ventas
-        devoluciones = cur.execute("SELECT id FROM puc WHERE codigo = '4175'").fetchone()  # Devoluciones en ventas
-        if ventas and devoluciones:
-            # Disminuye ventas
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, ?, 0, 'notas_credito', ?)""",
-                        (fecha, ventas["id"], descripcion, total, nota_id))
-            # Reconoce devolución
-            cur.execute("""INSERT INTO movimientos_contables
-                           (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                           VALUES (?, ?, ?, 0, ?, 'notas_credito', ?)""",
-                        (fecha, devoluciones["id"], descripcion, total, nota_id))
-        conn.commit()
-    except Exception as e:
-        print("Error asiento nota crédito:", e)
-    finally:
-        conn.close()
+        after = (after[0], int(after[1])) if after else None
+    except (TypeError, ValueError, IndexError, KeyError):
+        after = None
+    try:
+        limite = int(data.get("limit") or LISTA_LIMITE)
+    except (TypeError, ValueError):
+        limite = LISTA_LIMITE
+    return after, max(1, min(limite, LISTA_LIMITE_MAX))
+
+def quiere_ndjson(data):
+    return (data.get("formato") == "ndjson"
+            or request.accept_mimetypes.best == "application/x-ndjson")
+
+def _sql_keyset(sql, params, alias, after):
+    """Completa el {hasta} y el {despues} del WHERE y agrega el ORDER BY del keyset.
+
+    {hasta} va en lugar del ? del tope del rango de fechas (BETWEEN ? AND
+    {hasta}). Con cursor el tope baja a MIN(hasta, fecha del cursor): SQLite
+    toma el rango del índice de esa condición y la del cursor solo filtra, así
+    que sin bajar el tope cada página recorrería todas las filas más nuevas.
+    """
+    params = list(params)
+    hasta, despues = "?", ""
+    if after:
+        if "{hasta}" in sql:
+            hasta = "MIN(?, ?)"
+            params.insert(sql[:sql.index("{hasta}")].count("?") + 1, after[0])
+        else:
+            despues = f"AND {alias}.fecha <= ? "
+            params.append(after[0])
+        despues += f"AND ({alias}.fecha, {alias}.id) < (?, ?)"
+        params += list(after)
+    return sql.format(hasta=hasta, despues=despues) + f" ORDER BY {alias}.fecha DESC, {alias}.id DESC", params
+
+def consultar_pagina(cur, sql, params, alias, after, limite):
+    """Ejecuta sql, que debe traer un {despues} en el WHERE (y {hasta} si
+    filtra por rango de fechas), ordenado por fecha e id descendentes.
+    Devuelve (filas, next_after)."""
+    sql, params = _sql_keyset(sql, params, alias, after)
+    filas = cur.execute(sql + " LIMIT ?", params + [limite + 1]).fetchall()
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = [filas[-1]["fecha"], filas[-1]["id"]]
+    return filas, siguiente
+
+def responder_lista(clave, sql, params, alias, data, extra=None):
+    """Respuesta JSON paginada, o NDJSON en streaming si se pide formato=ndjson.
+
+    extra: campos adicionales para la respuesta JSON (no aplica en NDJSON).
+
+    En streaming se recorre el cursor fila por fila (sin fetchall), así que la
+    memoria no depende del tamaño del rango.
+    """
+    after, limite = leer_pagina(data)
+    cur = get_db_connection().cursor()
+    if quiere_ndjson(data):
+        sql, params = _sql_keyset(sql, params, alias, after)
+        if data.get("limit"):
+            sql += " LIMIT ?"
+            params.append(limite)
+
+        def generar():
+            for row in cur.execute(sql, params):
+                yield json.dumps(dict(row), ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generar()), mimetype="application/x-ndjson")
+    filas, siguiente = consultar_pagina(cur, sql, params, alias, after, limite)
+    return jsonify({"success": True, **(extra or {}), clave: [dict(r) for r in filas], "next_after": siguiente})
 
 # =========================
 # LOGIN
@@ -220,58 +1088,120 @@ def facturacion():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        clientes = cur.execute("""
-            SELECT id, nombres || ' ' || IFNULL(apellidos,'') as nombre
-            FROM terceros WHERE tipo='Cliente'
-        """).fetchall()
+        clientes = terceros_catalogo(cur, "Cliente")
     except Exception:
         clientes = []
     try:
-        productos = cur.execute("SELECT id, nombre, stock, costo, precio FROM productos").fetchall()
-    except Exception:
-        productos = []
-    try:
-        cur.execute("SELECT MAX(numero) FROM facturas")
-        last_num = cur.fetchone()[0] or 0
+        factura_num = proximo_numero(cur, "facturas")
     except Exception:
-        last_num = 0
+        factura_num = 1
     conn.close()
 
     return render_template(
         "facturacion.html",
         user=session["user"],
         clientes=clientes,
-        productos=productos,
-        factura_num=last_num + 1,
+        factura_num=factura_num,
         fecha=datetime.now().strftime("%Y-%m-%d")
     )
 
+def registrar_factura(cur, tercero_id, fecha, lineas, clave=None):
+    """Inserta la factura con su detalle, kardex, resumen y asientos. Devuelve (id, numero)."""
+    total = sum(float(l.get("total", 0)) for l in lineas)
+    factura_num = siguiente_numero(cur, "facturas")
+    cur.execute("INSERT INTO facturas (tercero_id, numero, fecha, total, clave) VALUES (?, ?, ?, ?, ?)",
+                (tercero_id, factura_num, fecha, total, clave))
+    factura_id = cur.lastrowid
+    cur.executemany("INSERT INTO detalle_factura (factura_id, producto_id, cantidad, precio, total) VALUES (?, ?, ?, ?, ?)",
+                    [(factura_id, l["producto_id"], l["cantidad"], l["precio"], l["total"]) for l in lineas])
+    costos = registrar_kardex(cur, fecha, "venta", factura_id,
+                              [(l["producto_id"], -float(l["cantidad"]), None) for l in lineas])
+    tocar_catalogo(cur, "productos")
+    acumular_resumen_venta(cur, fecha, tercero_id, total,
+                           [(l["producto_id"], l["cantidad"], l["total"]) for l in lineas])
+    acumular_caja(cur, "venta", total)
+    contabilizar(cur, "venta", factura_id, factura_num, fecha, total)
+    contabilizar_costo(cur, "costo_venta", factura_id, factura_num, fecha, costos)
+    return factura_id, factura_num
+
+def facturas_por_clave(cur, claves):
+    """{clave: numero} de las facturas ya registradas con esas claves."""
+    claves = list(claves)
+    if not claves:
+        return {}
+    marcas = ",".join("?" * len(claves))
+    return {r["clave"]: r["numero"] for r in
+            cur.execute(f"SELECT clave, numero FROM facturas WHERE clave IN ({marcas})", claves)}
+
 @app.route("/facturacion/save", methods=["POST"])
+@idempotente
 def facturacion_save():
     if "user" not in session:
         return jsonify({"success": False, "error": "No autorizado"})
     data = request.get_json()
     try:
         tercero_id = data.get("cliente_id")
-        factura_num = data.get("factura_num")
         fecha = data.get("fecha") or datetime.now().strftime("%Y-%m-%d")
         lineas = data.get("lines", [])
-        total = sum(float(l.get("total", 0)) for l in lineas)
+        clave = data.get("clave") or None
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO facturas (tercero_id, numero, fecha, total) VALUES (?, ?, ?, ?)", (tercero_id, factura_num, fecha, total))
-        factura_id = cur.lastrowid
-        for l in lineas:
-            cur.execute("INSERT INTO detalle_factura (factura_id, producto_id, cantidad, precio, total) VALUES (?, ?, ?, ?, ?)",
-                        (factura_id, l["producto_id"], l["cantidad"], l["precio"], l["total"]))
-            cur.execute("UPDATE productos SET stock = stock - ? WHERE id = ?", (l["cantidad"], l["producto_id"]))
-        conn.commit()
-        conn.close()
-
-        crear_asiento_venta(factura_id)
+        with transaccion() as cur:
+            previa = facturas_por_clave(cur, [clave] if clave else [])
+            if clave in previa:
+                return jsonify({"success": True, "factura_num": previa[clave], "duplicada": True})
+            _, factura_num = registrar_factura(cur, tercero_id, fecha, lineas, clave)
 
         return jsonify({"success": True, "factura_num": factura_num})
+    except ConflictoStock as e:
+        return jsonify(e.respuesta()), 409
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+SYNC_MAX_FACTURAS = 500
+
+@app.route("/facturacion/sync", methods=["POST"])
+def facturacion_sync():
+    """Recibe la cola de ventas hechas sin conexión: {"facturas": [{clave, cliente_id, fecha, lines}, ...]}.
+
+    Todo el lote va en una transacción (un solo commit). Las claves ya
+    registradas se devuelven como duplicadas sin volver a escribir, y cada
+    factura va en su savepoint: una que falla se informa sin deshacer las demás.
+    """
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    data = request.get_json()
+    try:
+        facturas = data.get("facturas", [])
+        if len(facturas) > SYNC_MAX_FACTURAS:
+            return jsonify({"success": False, "error": f"Máximo {SYNC_MAX_FACTURAS} facturas por lote"})
+        if any(not f.get("clave") for f in facturas):
+            return jsonify({"success": False, "error": "Cada factura requiere su clave"})
+
+        resultados = []
+        with transaccion() as cur:
+            registradas = facturas_por_clave(cur, {f["clave"] for f in facturas})
+            for f in facturas:
+                clave = f["clave"]
+                if clave in registradas:
+                    resultados.append({"clave": clave, "estado": "duplicada", "factura_num": registradas[clave]})
+                    continue
+                cur.execute("SAVEPOINT factura")
+                try:
+                    if not f.get("lines"):
+                        raise ValueError("Factura sin líneas")
+                    _, factura_num = registrar_factura(cur, f.get("cliente_id"),
+                                                       f.get("fecha") or datetime.now().strftime("%Y-%m-%d"),
+                                                       f["lines"], clave)
+                    cur.execute("RELEASE factura")
+                    registradas[clave] = factura_num
+                    resultados.append({"clave": clave, "estado": "creada", "factura_num": factura_num})
+                except Exception as e:
+                    cur.execute("ROLLBACK TO factura")
+                    cur.execute("RELEASE factura")
+                    resultados.append({"clave": clave, "estado": "error", "error": str(e),
+                                       "conflictos": getattr(e, "conflictos", None)})
+
+        return jsonify({"success": True, "resultados": resultados})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -286,19 +1216,21 @@ def facturas():
     
     conn = get_db_connection()
     cur = conn.cursor()
+    after, limite = leer_pagina(request.args)
     try:
-        facturas = cur.execute("""
+        facturas, siguiente = consultar_pagina(cur, """
             SELECT f.id, f.numero, f.fecha, f.total, 
                    t.nombres || ' ' || IFNULL(t.apellidos,'') as cliente
             FROM facturas f 
             LEFT JOIN terceros t ON f.tercero_id = t.id
-            ORDER BY f.fecha DESC, f.numero DESC
-        """).fetchall()
+            WHERE 1=1 {despues}
+        """, [], "f", after, limite)
     except Exception:
-        facturas = []
+        facturas, siguiente = [], None
     conn.close()
     
-    return render_template("lista_facturas.html", user=session["user"], facturas=facturas)
+    return render_template("lista_facturas.html", user=session["user"], facturas=facturas,
+                           siguiente=",".join(map(str, siguiente)) if siguiente else None)
 
 @app.route("/factura/<int:factura_id>")
 def ver_factura(factura_id):
@@ -321,11 +1253,6 @@ def ver_factura(factura_id):
             conn.close()
             return redirect(url_for("facturas"))
         
-        # Obtener tercero
-        tercero = cur.execute("""
-            SELECT nombres, apellidos, telefono, direccion
-            FROM terceros WHERE id = ?
-        """, (factura["tercero_id"],)).fetchone()
         
         # Obtener detalle
         detalle = cur.execute("""
@@ -351,7 +1278,7 @@ def ver_factura(factura_id):
     return render_template("factura_detalle.html", 
                          user=session["user"], 
                          factura=factura, 
-                         tercero=tercero,
+                         tercero=factura,   # los datos del cliente ya vienen en el JOIN
                          detalle=detalle,
                          notas_credito=notas_credito)
 
@@ -384,10 +1311,8 @@ def crear_nota_credito(factura_id):
             WHERE df.factura_id = ?
         """, (factura_id,)).fetchall()
         
-        # Obtener próximo número de nota de crédito
-        cur.execute("SELECT MAX(numero) FROM notas_credito")
-        last_num = cur.fetchone()[0] or 0
-        next_num = last_num + 1
+        # Próximo número de nota de crédito (el definitivo se asigna al guardar)
+        next_num = proximo_numero(cur, "notas_credito")
         
     except Exception as e:
         conn.close()
@@ -408,8 +1333,7 @@ def save_nota_credito():
     
     try:
         factura_id = request.form.get("factura_id")
-        numero = request.form.get("numero")
-        fecha = request.form.get("fecha")
+        fecha = request.form.get("fecha") or datetime.now().strftime("%Y-%m-%d")
         motivo = request.form.get("motivo")
         
         # Obtener arrays de detalle
@@ -424,45 +1348,46 @@ def save_nota_credito():
         if total_nota <= 0:
             return redirect(url_for("crear_nota_credito", factura_id=factura_id))
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Obtener tercero de la factura
-        factura_info = cur.execute("SELECT tercero_id FROM facturas WHERE id = ?", (factura_id,)).fetchone()
-        tercero_id = factura_info["tercero_id"] if factura_info else None
-        
-        # Insertar nota de crédito
-        cur.execute("""
-            INSERT INTO notas_credito (factura_id, numero, fecha, tercero_id, motivo, total, creado_por)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (factura_id, numero, fecha, tercero_id, motivo, total_nota, session["user"]))
-        
-        nota_id = cur.lastrowid
-        
-        # Insertar detalle y devolver inventario
-        for i in range(len(producto_ids)):
-            cantidad = float(cantidades[i]) if cantidades[i] else 0
-            if cantidad > 0:
-                precio = float(precios[i])
-                total_linea = float(totales_linea[i])
-                
-                # Insertar línea de detalle
-                cur.execute("""
-                    INSERT INTO detalle_nota_credito 
-                    (nota_id, producto_id, descripcion, cantidad, precio, total)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (nota_id, producto_ids[i], descripciones[i], cantidad, precio, total_linea))
-                
-                # Devolver inventario
-                cur.execute("""
-                    UPDATE productos SET stock = stock + ? WHERE id = ?
-                """, (cantidad, producto_ids[i]))
-        
-        conn.commit()
-        conn.close()
-        
-        # Crear asiento contable
-        crear_asiento_nota_credito(nota_id)
+        with transaccion() as cur:
+            # Obtener tercero de la factura
+            factura_info = cur.execute("SELECT tercero_id FROM facturas WHERE id = ?", (factura_id,)).fetchone()
+            tercero_id = factura_info["tercero_id"] if factura_info else None
+            numero = siguiente_numero(cur, "notas_credito")
+            
+            # Insertar nota de crédito
+            cur.execute("""
+                INSERT INTO notas_credito (factura_id, numero, fecha, tercero_id, motivo, total, creado_por)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (factura_id, numero, fecha, tercero_id, motivo, total_nota, session["user"]))
+            
+            nota_id = cur.lastrowid
+            
+            # Insertar detalle y devolver inventario
+            detalle = []
+            for i in range(len(producto_ids)):
+                cantidad = float(cantidades[i]) if cantidades[i] else 0
+                if cantidad > 0:
+                    detalle.append((nota_id, producto_ids[i], descripciones[i], cantidad,
+                                    float(precios[i]), float(totales_linea[i])))
+            cur.executemany("""
+                INSERT INTO detalle_nota_credito 
+                (nota_id, producto_id, descripcion, cantidad, precio, total)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, detalle)
+            # La devolución reingresa al costo con que salió en la factura
+            costo_venta = {row["producto_id"]: row["costo_unitario"] for row in cur.execute(
+                "SELECT producto_id, costo_unitario FROM kardex WHERE tipo = 'venta' AND documento_id = ?",
+                (factura_id,))}
+            costos = registrar_kardex(cur, fecha, "nota_credito", nota_id,
+                                      [(d[1], d[3], costo_venta.get(int(d[1]))) for d in detalle])
+            tocar_catalogo(cur, "productos")
+            acumular_resumen_venta(cur, fecha, tercero_id, -total_nota,
+                                   [(d[1], -d[3], -d[5]) for d in detalle], documentos=0)
+            acumular_caja(cur, "devolucion", total_nota)
+            
+            # Crear asiento contable
+            contabilizar(cur, "nota_credito", nota_id, numero, fecha, total_nota)
+            contabilizar_costo(cur, "costo_devolucion", nota_id, numero, fecha, costos)
         
         return redirect(url_for("ver_factura", factura_id=factura_id))
         
@@ -479,23 +1404,19 @@ def compras():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        proveedores = cur.execute("SELECT id, nombres || ' ' || IFNULL(apellidos,'') as nombre FROM terceros WHERE tipo='Proveedor'").fetchall()
+        proveedores = terceros_catalogo(cur, "Proveedor")
     except Exception:
         proveedores = []
     try:
-        productos = cur.execute("SELECT id, nombre, stock, costo FROM productos").fetchall()
-    except Exception:
-        productos = []
-    try:
-        cur.execute("SELECT MAX(id) FROM compras")
-        last_num = cur.fetchone()[0] or 0
+        compra_num = proximo_numero(cur, "compras")
     except Exception:
-        last_num = 0
+        compra_num = 1
     conn.close()
 
-    return render_template("compras.html", user=session["user"], proveedores=proveedores, productos=productos, compra_num=last_num + 1, fecha=datetime.now().strftime("%Y-%m-%d"))
+    return render_template("compras.html", user=session["user"], proveedores=proveedores, compra_num=compra_num, fecha=datetime.now().strftime("%Y-%m-%d"))
 
 @app.route("/compras/save", methods=["POST"])
+@idempotente
 def compras_save():
     if "user" not in session:
         return jsonify({"success": False, "error": "No autorizado"}), 401
@@ -503,38 +1424,35 @@ def compras_save():
     try:
         data = request.get_json()
         proveedor_id = data.get("proveedor_id")
-        numero = data.get("numero")
         fecha = data.get("fecha")
         forma_pago = data.get("forma_pago")
         lines = data.get("lines", [])
 
         total = sum(float(l["total"]) for l in lines)
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Cabecera
-        cur.execute("""
-            INSERT INTO compras (tercero_id, numero, fecha, total, forma_pago, pagada)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (proveedor_id, numero, fecha, total, forma_pago, 1 if forma_pago=="contado" else 0))
-        compra_id = cur.lastrowid
-
-        # Detalle y actualización de inventario
-        for l in lines:
+        with transaccion() as cur:
+            # Cabecera
+            numero = str(siguiente_numero(cur, "compras"))
             cur.execute("""
+                INSERT INTO compras (tercero_id, numero, fecha, total, forma_pago, pagada)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (proveedor_id, numero, fecha, total, forma_pago, 1 if forma_pago=="contado" else 0))
+            compra_id = cur.lastrowid
+
+            # Detalle e inventario (el costo de compra entra al promedio ponderado)
+            cur.executemany("""
                 INSERT INTO detalle_compra (compra_id, producto_id, cantidad, costo, total)
                 VALUES (?, ?, ?, ?, ?)
-            """, (compra_id, l["producto_id"], l["cantidad"], l["costo"], l["total"]))
-
-            cur.execute("""
-                UPDATE productos
-                SET stock = stock + ?, costo = ?
-                WHERE id = ?
-            """, (l["cantidad"], l["costo"], l["producto_id"]))
+            """, [(compra_id, l["producto_id"], l["cantidad"], l["costo"], l["total"]) for l in lines])
+            registrar_kardex(cur, fecha, "compra", compra_id,
+                             [(l["producto_id"], float(l["cantidad"]), float(l["costo"])) for l in lines])
+            tocar_catalogo(cur, "productos")
+            acumular_resumen_compra(cur, fecha, proveedor_id, total, forma_pago == "contado",
+                                    [(l["producto_id"], l["cantidad"], l["total"]) for l in lines])
+            if forma_pago == "contado":
+                acumular_caja(cur, "compra_contado", total)
 
-        conn.commit()
-        conn.close()
+            contabilizar(cur, "compra", compra_id, numero, fecha, total, forma_pago)
 
         return jsonify({"success": True, "compra_num": numero})
     except Exception as e:
@@ -548,15 +1466,8 @@ def compras_save():
 def inventario():
     if "user" not in session:
         return redirect(url_for("login"))
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        productos_raw = cur.execute("SELECT id, nombre, stock, costo, precio FROM productos").fetchall()
-    except Exception:
-        productos_raw = []
-    conn.close()
-    productos = [{"id": p[0], "nombre": p[1], "stock": p[2], "costo": p[3], "precio": p[4]} for p in productos_raw]
-    return render_template("inventario.html", user=session["user"], productos=productos)
+    # La tabla se llena desde /api/productos/search
+    return render_template("inventario.html", user=session["user"])
 
 @app.route("/add_producto", methods=["POST"])
 def add_producto():
@@ -568,13 +1479,17 @@ def add_producto():
         stock = float(data.get("stock", 0))
         costo = float(data.get("costo", 0))
         precio = float(data.get("precio", 0))
+        stock_minimo = float(data.get("stock_minimo") or 0)
         if not nombre:
             return jsonify({"success": False, "error": "Nombre requerido"})
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("INSERT INTO productos (nombre, stock, costo, precio) VALUES (?, ?, ?, ?)", (nombre, stock, costo, precio))
-        conn.commit()
+        cur.execute("INSERT INTO productos (nombre, stock, costo, precio, stock_minimo) VALUES (?, ?, ?, ?, ?)",
+                    (nombre, stock, costo, precio, stock_minimo))
         nuevo_id = cur.lastrowid
+        fijar_saldos_kardex(cur, datetime.now().strftime("%Y-%m-%d"), "inicial", [(nuevo_id, stock, costo, 0, 0)])
+        tocar_catalogo(cur, "productos")
+        conn.commit()
         conn.close()
         return jsonify({"success": True, "id": nuevo_id, "mensaje": f"Producto '{nombre}' agregado correctamente"})
     except Exception as e:
@@ -592,12 +1507,29 @@ def update_producto(producto_id):
         precio = float(data.get("precio", 0))
         if not nombre:
             return jsonify({"success": False, "error": "Nombre requerido"})
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE productos SET nombre=?, stock=?, costo=?, precio=? WHERE id=?", (nombre, stock, costo, precio, producto_id))
-        conn.commit()
-        conn.close()
-        return jsonify({"success": True, "mensaje": "Producto actualizado correctamente"})
+        stock_minimo = data.get("stock_minimo")
+        stock_minimo = float(stock_minimo) if stock_minimo not in (None, "") else None
+        version = data.get("version")
+        with transaccion() as cur:
+            anterior = cur.execute("SELECT stock, costo FROM productos WHERE id=?", (producto_id,)).fetchone()
+            if anterior is None:
+                return jsonify({"success": False, "error": "Producto no encontrado"})
+            # Con version, solo se escribe si nadie (p. ej. una venta) cambió el producto desde que se leyó
+            nueva = cur.execute("""
+                UPDATE productos SET nombre=?, stock=?, costo=?, precio=?, stock_minimo = COALESCE(?, stock_minimo),
+                                     version = version + 1
+                WHERE id=? AND (? IS NULL OR version = ?)
+                RETURNING version
+            """, (nombre, stock, costo, precio, stock_minimo, producto_id, version, version)).fetchone()
+            if nueva is None:
+                raise ConflictoStock(conflictos_stock(cur, {producto_id: None}))
+            if anterior["stock"] != stock or anterior["costo"] != costo:
+                fijar_saldos_kardex(cur, datetime.now().strftime("%Y-%m-%d"), "ajuste",
+                                    [(producto_id, stock, costo, anterior["stock"], anterior["costo"])])
+            tocar_catalogo(cur, "productos")
+        return jsonify({"success": True, "mensaje": "Producto actualizado correctamente", "version": nueva["version"]})
+    except ConflictoStock as e:
+        return jsonify(e.respuesta()), 409
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -609,12 +1541,325 @@ def delete_producto(producto_id):
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute("DELETE FROM productos WHERE id=?", (producto_id,))
+        tocar_catalogo(cur, "productos")
         conn.commit()
         conn.close()
         return jsonify({"success": True, "mensaje": "Producto eliminado correctamente"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/api/kardex/<int:producto_id>", methods=["GET", "POST"])
+def api_kardex(producto_id):
+    """Kardex del producto entre fecha_inicio y fecha_fin, del más reciente al más antiguo.
+
+    Trae además las existencias al inicio y al cierre del rango. Sin
+    fecha_inicio arranca en kardex_desde; antes de esa fecha responde 422.
+    """
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    data = request.get_json(silent=True) or request.args
+    hoy = datetime.now().strftime("%Y-%m-%d")
+    fecha_fin = data.get("fecha_fin") or hoy
+    try:
+        cur = get_db_connection().cursor()
+        desde = kardex_desde(cur)
+        fecha_inicio = data.get("fecha_inicio") or desde or "0000-00-00"
+        if desde and fecha_inicio < desde:
+            return sin_datos_kardex(desde)
+        dia_anterior = cur.execute("SELECT date(?, '-1 day')", (fecha_inicio,)).fetchone()[0] or "0000-00-00"
+        inicial = existencias_al(cur, dia_anterior, producto_id)
+        if inicial is None:
+            return jsonify({"success": False, "error": "Producto no encontrado"}), 404
+        cierre = existencias_al(cur, fecha_fin, producto_id)
+        return responder_lista("kardex", """
+            SELECT k.id, k.fecha, k.tipo, k.documento_id, k.cantidad, k.costo_unitario, k.valor,
+                   k.saldo_cantidad, k.saldo_valor, k.costo_promedio
+            FROM kardex k
+            WHERE k.producto_id = ? AND k.fecha BETWEEN ? AND {hasta} {despues}
+        """, (producto_id, fecha_inicio, fecha_fin), "k", data, extra={
+            "producto": {"id": producto_id, "nombre": inicial["nombre"]},
+            "saldo_inicial": {"cantidad": inicial["cantidad"], "valor": inicial["valor"]},
+            "saldo_final": {"cantidad": cierre["cantidad"], "valor": cierre["valor"]},
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/api/inventario/corte", methods=["GET", "POST"])
+def api_inventario_corte():
+    """Inventario (cantidad y valor por producto) al cierre de una fecha.
+
+    Antes de kardex_desde no hay datos: responde 422 en lugar de existencias en cero.
+    """
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    data = request.get_json(silent=True) or request.args
+    fecha = data.get("fecha") or datetime.now().strftime("%Y-%m-%d")
+    try:
+        cur = get_db_connection().cursor()
+        desde = kardex_desde(cur)
+        if desde and fecha < desde:
+            return sin_datos_kardex(desde)
+        productos = [dict(r) for r in existencias_al(cur, fecha)]
+        return jsonify({"success": True, "fecha": fecha, "productos": productos,
+                        "valor_total": sum(p["valor"] for p in productos)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/api/inventario/resumen")
+def api_inventario_resumen():
+    """Totales del catálogo completo para el panel de estadísticas (una consulta)."""
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    try:
+        row = get_db_connection().execute("""
+            SELECT COUNT(*) AS productos, IFNULL(SUM(stock), 0) AS stock, IFNULL(SUM(stock * costo), 0) AS valor,
+                   (SELECT COUNT(*) FROM alertas_stock) AS bajo_minimo
+            FROM productos
+        """).fetchone()
+        return jsonify({"success": True, **dict(row)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/api/inventario/alertas")
+def api_inventario_alertas():
+    """Productos en o por debajo de su stock mínimo.
+
+    Lee alertas_stock, que los triggers de productos mantienen al día, así
+    que no recorre el catálogo. Primero los agotados, luego por faltante.
+    """
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    try:
+        cur = get_db_connection().cursor()
+        alertas = [dict(r) for r in cur.execute("""
+            SELECT a.producto_id, p.nombre, a.stock, a.stock_minimo, a.stock_minimo - a.stock AS faltante, a.desde
+            FROM alertas_stock a CROSS JOIN productos p ON p.id = a.producto_id  -- CROSS: alertas_stock siempre primero
+            ORDER BY a.stock > 0, faltante DESC
+        """)]
+        return jsonify({"success": True, "total": len(alertas), "alertas": alertas})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+# =========================
+# IMPORTACIÓN MASIVA (CSV)
+# =========================
+# El archivo se lee fila por fila y se escribe en lotes de IMPORT_LOTE filas
+# por transacción. Las filas existentes se actualizan (clave natural: nombre
+# del producto; nombres + apellidos + tipo del tercero) y las celdas vacías
+# no pisan lo que ya hay. Si la clave está repetida en la tabla se toma la
+# fila más antigua (menor id); si se repite en el archivo, las filas se
+# combinan con la misma regla de celdas vacías. Los errores se reportan con
+# su número de línea y no detienen el resto del archivo.
+IMPORT_LOTE = 2000
+IMPORT_MAX_ERRORES = 1000
+
+def _texto(fila, campo):
+    return (fila.get(campo) or "").strip() or None
+
+def _numero(fila, campo):
+    valor = _texto(fila, campo)
+    if valor is None:
+        return None
+    try:
+        return float(valor.replace(",", "."))
+    except ValueError:
+        raise ValueError(f"{campo} no es un número: {valor!r}")
+
+def _validar_producto(fila):
+    nombre = _texto(fila, "nombre")
+    if not nombre:
+        raise ValueError("nombre requerido")
+    datos = {"nombre": nombre, "descripcion": _texto(fila, "descripcion")}
+    for campo in ("precio", "costo", "stock", "stock_minimo"):
+        datos[campo] = _numero(fila, campo)
+        if campo != "stock" and datos[campo] is not None and datos[campo] < 0:
+            raise ValueError(f"{campo} negativo")
+    return nombre, datos
+
+def _validar_tercero(fila):
+    nombres = _texto(fila, "nombres")
+    if not nombres:
+        raise ValueError("nombres requerido")
+    tipo = (_texto(fila, "tipo") or "Cliente").capitalize()
+    if tipo not in ("Cliente", "Proveedor"):
+        raise ValueError(f"tipo inválido: {tipo}")
+    datos = {campo: _texto(fila, campo) for campo in ("apellidos", "telefono", "correo", "direccion")}
+    datos.update(nombres=nombres, tipo=tipo)
+    return (nombres, datos["apellidos"] or "", tipo), datos
+
+def _cargar_productos(cur, lote, fecha):
+    """Upsert de un lote {nombre: datos}. Devuelve (insertados, actualizados)."""
+    nombres = list(lote)
+    marcas = ", ".join(["?"] * len(nombres))
+    existentes = {}
+    for row in cur.execute(f"SELECT id, nombre, stock, costo FROM productos WHERE nombre IN ({marcas}) ORDER BY id",
+                           nombres):
+        existentes.setdefault(row["nombre"], row)
+    nuevos = [d for n, d in lote.items() if n not in existentes]
+    cur.executemany("INSERT INTO productos (nombre, descripcion, precio, costo, stock, stock_minimo) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(d["nombre"], d["descripcion"], d["precio"] or 0, d["costo"] or 0, d["stock"] or 0,
+                      d["stock_minimo"] or 0) for d in nuevos])
+    cur.executemany("""
+        UPDATE productos SET precio = COALESCE(?, precio), costo = COALESCE(?, costo), stock = COALESCE(?, stock),
+                             stock_minimo = COALESCE(?, stock_minimo), version = version + 1
+        WHERE id = ?
+    """, [(d["precio"], d["costo"], d["stock"], d["stock_minimo"], existentes[n]["id"])
+          for n, d in lote.items() if n in existentes])
+    # La descripción aparte y solo si cambió, para no reindexar en FTS lo que sigue igual
+    cur.executemany("UPDATE productos SET descripcion = ? WHERE id = ? AND descripcion IS NOT ?",
+                    [(d["descripcion"], existentes[n]["id"], d["descripcion"])
+                     for n, d in lote.items() if n in existentes and d["descripcion"] is not None])
+
+    saldos = []
+    if nuevos:
+        marcas = ", ".join(["?"] * len(nuevos))
+        ids = {row["nombre"]: row["id"] for row in cur.execute(
+            f"SELECT MIN(id) AS id, nombre FROM productos WHERE nombre IN ({marcas}) GROUP BY nombre",
+            [d["nombre"] for d in nuevos])}
+        saldos += [(ids[d["nombre"]], d["stock"] or 0, d["costo"] or 0, 0, 0) for d in nuevos]
+    for n, d in lote.items():
+        ant = existentes.get(n)
+        if ant is None or (d["stock"] is None and d["costo"] is None):
+            continue
+        stock = d["stock"] if d["stock"] is not None else ant["stock"]
+        costo = d["costo"] if d["costo"] is not None else ant["costo"]
+        if (stock, costo) != (ant["stock"], ant["costo"]):
+            saldos.append((ant["id"], stock, costo, ant["stock"], ant["costo"]))
+    fijar_saldos_kardex(cur, fecha, "inicial", saldos)
+    tocar_catalogo(cur, "productos")
+    return len(nuevos), len(lote) - len(nuevos)
+
+def _cargar_terceros(cur, lote, fecha):
+    """Upsert de un lote {(nombres, apellidos, tipo): datos}. Devuelve (insertados, actualizados)."""
+    nombres = list({clave[0] for clave in lote})
+    marcas = ", ".join(["?"] * len(nombres))
+    existentes = {}
+    for row in cur.execute(f"SELECT id, nombres, apellidos, tipo FROM terceros WHERE nombres IN ({marcas}) ORDER BY id",
+                           nombres):
+        existentes.setdefault((row["nombres"], row["apellidos"] or "", row["tipo"]), row["id"])
+    nuevos = [d for clave, d in lote.items() if clave not in existentes]
+    cur.executemany("""
+        INSERT INTO terceros (nombres, apellidos, telefono, correo, direccion, tipo)
+        VALUES (:nombres, :apellidos, :telefono, :correo, :direccion, :tipo)
+    """, nuevos)
+    cur.executemany("""
+        UPDATE terceros SET telefono = COALESCE(:telefono, telefono), correo = COALESCE(:correo, correo),
+                            direccion = COALESCE(:direccion, direccion)
+        WHERE id = :id
+    """, [dict(d, id=existentes[clave]) for clave, d in lote.items() if clave in existentes])
+    tocar_catalogo(cur, "terceros")
+    return len(nuevos), len(lote) - len(nuevos)
+
+IMPORTADORES = {
+    "productos": (_validar_producto, _cargar_productos),
+    "terceros": (_validar_tercero, _cargar_terceros),
+}
+
+def importar_csv(tipo, archivo, fecha=None, lote=IMPORT_LOTE):
+    """Importa un CSV (objeto de texto) de productos o terceros.
+
+    Es un generador: produce un dict de avance por cada lote escrito y al
+    final el resumen con "fin": True. Con productos, las columnas stock y
+    costo fijan el saldo inicial en kardex.
+    """
+    validar, cargar = IMPORTADORES[tipo]
+    fecha = fecha or datetime.now().strftime("%Y-%m-%d")
+    lector = csv.DictReader(archivo, delimiter=_delimitador(archivo))
+    resumen = {"tipo": tipo, "lineas": 0, "insertados": 0, "actualizados": 0, "errores": [], "num_errores": 0}
+
+    def error(linea, mensaje):
+        resumen["num_errores"] += 1
+        if len(resumen["errores"]) < IMPORT_MAX_ERRORES:
+            resumen["errores"].append({"linea": linea, "error": mensaje})
+
+    def escribir(pendiente, primera, ultima):
+        try:
+            with transaccion() as cur:
+                insertados, actualizados = cargar(cur, pendiente, fecha)
+            resumen["insertados"] += insertados
+            resumen["actualizados"] += actualizados
+        except Exception as e:
+            error(f"{primera}-{ultima}", f"lote no guardado: {e}")
+
+    pendiente, primera = {}, None
+    for fila in lector:
+        resumen["lineas"] += 1
+        linea = lector.line_num
+        try:
+            clave, datos = validar({(k or "").strip().lower(): v for k, v in fila.items()})
+        except ValueError as e:
+            error(linea, str(e))
+            continue
+        primera = primera or linea
+        previo = pendiente.get(clave)
+        if previo is not None:              # repetida en el lote: las celdas no vacías de la última completan la anterior
+            datos = dict(previo, **{k: v for k, v in datos.items() if v is not None})
+        pendiente[clave] = datos
+        if len(pendiente) >= lote:
+            escribir(pendiente, primera, linea)
+            pendiente, primera = {}, None
+            yield {"linea": linea, "insertados": resumen["insertados"],
+                   "actualizados": resumen["actualizados"], "errores": resumen["num_errores"]}
+    if pendiente:
+        escribir(pendiente, primera, lector.line_num)
+    yield dict(resumen, fin=True)
+
+def _delimitador(archivo):
+    """Detecta ; o , mirando la primera línea sin consumirla."""
+    try:
+        muestra = archivo.buffer.peek(4096)[:4096].decode("utf-8", "ignore")
+    except (AttributeError, OSError):
+        return ","
+    primera = muestra.splitlines()[0] if muestra else ""
+    return ";" if primera.count(";") > primera.count(",") else ","
+
+@app.route("/api/importar/<tipo>", methods=["POST"])
+def api_importar(tipo):
+    """Importa un CSV subido como archivo (campo "archivo") o enviado como cuerpo text/csv.
+
+    Responde el resumen en JSON, o el avance lote por lote en NDJSON
+    (?formato=ndjson).
+    """
+    if "user" not in session or session.get("rol") != "admin":
+        return jsonify({"success": False, "error": "No autorizado"}), 403
+    if tipo not in IMPORTADORES:
+        return jsonify({"success": False, "error": f"Tipo desconocido: {tipo}"}), 404
+    subido = request.files.get("archivo")
+    crudo = subido.stream if subido else request.stream
+    if not hasattr(crudo, "peek"):
+        crudo = io.BufferedReader(crudo)
+    archivo = io.TextIOWrapper(crudo, encoding="utf-8-sig", newline="")
+    fecha = request.args.get("fecha")
+    lote = max(1, min(request.args.get("lote", IMPORT_LOTE, type=int), 50000))
+    if quiere_ndjson(request.args):
+        def generar():
+            for avance in importar_csv(tipo, archivo, fecha, lote):
+                yield json.dumps(avance, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generar()), mimetype="application/x-ndjson")
+    try:
+        *_, resumen = importar_csv(tipo, archivo, fecha, lote)
+        return jsonify({"success": True, **resumen})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.cli.command("importar")
+@click.argument("tipo", type=click.Choice(sorted(IMPORTADORES)))
+@click.argument("ruta", type=click.Path(exists=True, dir_okay=False))
+@click.option("--lote", default=IMPORT_LOTE, show_default=True, help="Filas por transacción")
+@click.option("--fecha", default=None, help="Fecha de los saldos iniciales (por defecto hoy)")
+def importar_cmd(tipo, ruta, lote, fecha):
+    """Importa productos o terceros desde un CSV."""
+    inicio = time.perf_counter()
+    with open(ruta, encoding="utf-8-sig", newline="") as archivo:
+        for avance in importar_csv(tipo, archivo, fecha, lote):
+            if not avance.get("fin"):
+                print(f"línea {avance['linea']}: {avance['insertados']} nuevos, "
+                      f"{avance['actualizados']} actualizados, {avance['errores']} errores")
+    print(f"✅ {avance['lineas']} líneas en {time.perf_counter() - inicio:.1f} s: {avance['insertados']} nuevos, "
+          f"{avance['actualizados']} actualizados, {avance['num_errores']} errores")
+    for e in avance["errores"][:50]:
+        print(f"  línea {e['linea']}: {e['error']}")
+
 # =========================
 # API / DEBUG: listar productos (útil para verificar DB)
 # =========================
@@ -622,16 +1867,71 @@ def delete_producto(producto_id):
 def api_productos():
     if "user" not in session:
         return jsonify({"success": False, "error": "No autorizado"}), 401
-    conn = get_db_connection()
-    cur = conn.cursor()
     try:
-        prows = cur.execute("SELECT id, nombre, stock, costo, precio FROM productos ORDER BY nombre").fetchall()
-        productos = [dict(p) for p in prows]
+        return respuesta_catalogo("productos", "todos", _productos_todos)
     except Exception as e:
         print("Error en api_productos:", e)
-        productos = []
-    conn.close()
-    return jsonify(productos)
+        return jsonify([])
+
+PRODUCTOS_BUSQUEDA_LIMITE = 20
+PRODUCTOS_BUSQUEDA_MAX = 200
+# Filtros y órdenes de la tabla de inventario (?stock= y ?orden=)
+PRODUCTOS_FILTRO_STOCK = {
+    "alto": "p.stock > 50",
+    "medio": "p.stock > 10 AND p.stock <= 50",
+    "bajo": "p.stock > 0 AND p.stock <= 10",
+    "agotado": "p.stock <= 0",
+}
+PRODUCTOS_ORDEN = {
+    "nombre": "p.nombre",
+    "stock-desc": "p.stock DESC, p.nombre",
+    "stock-asc": "p.stock, p.nombre",
+    "costo-desc": "p.costo DESC, p.nombre",
+    "costo-asc": "p.costo, p.nombre",
+}
+
+def consulta_fts(texto):
+    """Convierte lo que escribe el cajero en una consulta FTS5 por prefijos."""
+    return " ".join(f'"{t}"*' for t in re.findall(r"\w+", texto))
+
+@app.route("/api/productos/search")
+def api_productos_search():
+    """Top-N productos que coinciden con q (sin q: los primeros por nombre).
+
+    Opcionales: stock= (alto, medio, bajo, agotado) filtra y orden= cambia el
+    orden (ver PRODUCTOS_ORDEN). total es cuántos cumplen en todo el catálogo;
+    solo se cuenta aparte cuando la página salió llena.
+    """
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    consulta = consulta_fts(request.args.get("q", ""))
+    try:
+        limite = int(request.args.get("limit") or PRODUCTOS_BUSQUEDA_LIMITE)
+    except ValueError:
+        limite = PRODUCTOS_BUSQUEDA_LIMITE
+    limite = max(1, min(limite, PRODUCTOS_BUSQUEDA_MAX))
+    filtro = PRODUCTOS_FILTRO_STOCK.get(request.args.get("stock"), "1=1")
+    orden = PRODUCTOS_ORDEN.get(request.args.get("orden"))
+    try:
+        cur = get_db_connection().cursor()
+        if consulta:
+            desde = "FROM productos_fts JOIN productos p ON p.id = productos_fts.rowid WHERE productos_fts MATCH ? AND "
+            params = [consulta]
+            orden = orden or "productos_fts.rank, p.nombre"
+        else:
+            desde = "FROM productos p WHERE "
+            params = []
+            orden = orden or "p.nombre"
+        prows = cur.execute(f"""
+            SELECT p.id, p.nombre, p.descripcion, p.stock, p.costo, p.precio, p.stock_minimo, p.version
+            {desde}{filtro} ORDER BY {orden} LIMIT ?
+        """, params + [limite]).fetchall()
+        total = len(prows)
+        if total == limite:
+            total = cur.execute(f"SELECT COUNT(*) {desde}{filtro}", params).fetchone()[0]
+        return jsonify({"success": True, "productos": [dict(p) for p in prows], "total": total})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
 
 
 # =========================
@@ -645,8 +1945,6 @@ def transformaciones():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        prows = cur.execute("SELECT id, nombre, stock, costo, precio FROM productos ORDER BY nombre").fetchall()
-        productos = [dict(p) for p in prows]
         trows = cur.execute("""
             SELECT id, numero, fecha, descripcion, total_salida, total_entrada, creado_por
             FROM transformaciones
@@ -655,7 +1953,7 @@ def transformaciones():
         transformaciones = [dict(t) for t in trows]
     except Exception as e:
         print("Error cargando transformaciones:", e)
-        productos, transformaciones = [], []
+        transformaciones = []
     finally:
         conn.close()
 
@@ -663,12 +1961,12 @@ def transformaciones():
     fecha_hoy = datetime.now().strftime("%Y-%m-%d")
     return render_template("transformaciones.html",
                            user=session["user"],
-                           productos=productos,
                            transformaciones=transformaciones,
                            fecha_hoy=fecha_hoy)
 
 
 @app.route("/transformaciones/save", methods=["POST"])
+@idempotente
 def save_transformacion():
     if "user" not in session:
         return jsonify({"success": False, "error": "No autorizado"}), 401
@@ -683,83 +1981,76 @@ def save_transformacion():
         total_salida = 0.0
         total_entrada = 0.0
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # ✅ Consecutivo automático
-        cur.execute("SELECT IFNULL(MAX(numero), 0) + 1 AS next_num FROM transformaciones")
-        row = cur.fetchone()
-        numero = row["next_num"]
-
-        # Insertar cabecera
-        cur.execute("""
-            INSERT INTO transformaciones (numero, fecha, descripcion, total_salida, total_entrada, creado_por)
-            VALUES (?, ?, ?, 0, 0, ?)
-        """, (numero, fecha, descripcion, session["user"]))
-        trans_id = cur.lastrowid
-
-        # Registrar salidas (disminuye stock)
-        for s in salidas:
-            pid = int(s.get("producto_id"))
-            cant = float(s.get("cantidad") or 0)
-            if cant <= 0:
-                continue
-            prod = cur.execute("SELECT costo FROM productos WHERE id=?", (pid,)).fetchone()
-            costo_unit = float(prod["costo"]) if prod and prod["costo"] is not None else 0.0
-            total = cant * costo_unit
-            total_salida += total
-
-            cur.execute("""
-                INSERT INTO detalle_transformacion (transformacion_id, tipo, producto_id, cantidad, costo, total)
-                VALUES (?, 'salida', ?, ?, ?, ?)
-            """, (trans_id, pid, cant, costo_unit, total))
-
-            cur.execute("UPDATE productos SET stock = stock - ? WHERE id=?", (cant, pid))
-
-        # Registrar entradas (aumenta stock)
-        for e in entradas:
-            pid = int(e.get("producto_id"))
-            cant = float(e.get("cantidad") or 0)
-            costo_unit = float(e.get("costo") or 0)
-            if cant <= 0:
-                continue
-            total = cant * costo_unit
-            total_entrada += total
+        with transaccion() as cur:
+            # ✅ Consecutivo automático
+            numero = siguiente_numero(cur, "transformaciones")
 
+            # Insertar cabecera
             cur.execute("""
+                INSERT INTO transformaciones (numero, fecha, descripcion, total_salida, total_entrada, creado_por)
+                VALUES (?, ?, ?, 0, 0, ?)
+            """, (numero, fecha, descripcion, session["user"]))
+            trans_id = cur.lastrowid
+
+            salidas = [(int(s.get("producto_id")), float(s.get("cantidad") or 0)) for s in salidas]
+            salidas = [(pid, cant) for pid, cant in salidas if cant > 0]
+            entradas = [(int(e.get("producto_id")), float(e.get("cantidad") or 0), float(e.get("costo") or 0) or None)
+                        for e in entradas]
+            entradas = [(pid, cant, costo) for pid, cant, costo in entradas if cant > 0]
+
+            # Salidas al costo promedio vigente
+            valores_salida = registrar_kardex(cur, fecha, "transformacion_salida", trans_id,
+                                              [(pid, -cant, None) for pid, cant in salidas])
+            cantidad_salida = defaultdict(float)
+            for pid, cant in salidas:
+                cantidad_salida[pid] += cant
+            total_salida = -sum(valores_salida.values())
+
+            # Las entradas sin costo heredan lo que salió y no cubren las que sí lo traen
+            # (repartido por cantidad); si no queda nada, entran al promedio vigente
+            cantidad_sin_costo = sum(cant for _, cant, costo_unit in entradas if costo_unit is None)
+            restante = total_salida - sum(cant * costo_unit for _, cant, costo_unit in entradas if costo_unit is not None)
+            if cantidad_sin_costo and restante > 0:
+                entradas = [(pid, cant, restante / cantidad_sin_costo if costo_unit is None else costo_unit)
+                            for pid, cant, costo_unit in entradas]
+            valores_entrada = registrar_kardex(cur, fecha, "transformacion_entrada", trans_id, entradas)
+            sin_costo, resto = defaultdict(float), dict(valores_entrada)
+            for pid, cant, costo_unit in entradas:
+                if costo_unit is None:
+                    sin_costo[pid] += cant
+                else:
+                    resto[pid] = resto.get(pid, 0.0) - cant * costo_unit
+
+            detalle = []
+            # Registrar salidas (disminuye stock)
+            for pid, cant in salidas:
+                costo_unit = -valores_salida.get(pid, 0.0) / cantidad_salida[pid]
+                detalle.append((trans_id, "salida", pid, cant, costo_unit, cant * costo_unit))
+
+            # Registrar entradas (aumenta stock); las que quedaron sin costo, al que les dio el kardex
+            for pid, cant, costo_unit in entradas:
+                if costo_unit is None:
+                    costo_unit = resto.get(pid, 0.0) / sin_costo[pid]
+                total = cant * costo_unit
+                total_entrada += total
+                detalle.append((trans_id, "entrada", pid, cant, costo_unit, total))
+
+            cur.executemany("""
                 INSERT INTO detalle_transformacion (transformacion_id, tipo, producto_id, cantidad, costo, total)
-                VALUES (?, 'entrada', ?, ?, ?, ?)
-            """, (trans_id, pid, cant, costo_unit, total))
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, detalle)
+            tocar_catalogo(cur, "productos")
 
-            cur.execute("UPDATE productos SET stock = stock + ?, costo = ? WHERE id = ?", (cant, costo_unit, pid))
+            # Actualizar totales
+            cur.execute("UPDATE transformaciones SET total_salida=?, total_entrada=? WHERE id=?",
+                        (total_salida, total_entrada, trans_id))
 
-        # Actualizar totales
-        cur.execute("UPDATE transformaciones SET total_salida=?, total_entrada=? WHERE id=?",
-                    (total_salida, total_entrada, trans_id))
-
-        conn.commit()
-        conn.close()
-
-        # Registrar asiento contable 1435 contra 1435
-        try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            inventario = cur.execute("SELECT id FROM puc WHERE codigo='1435'").fetchone()
-            if inventario:
-                cur.execute("""
-                    INSERT INTO movimientos_contables (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                    VALUES (?, ?, ?, ?, 0, 'transformacion', ?)
-                """, (fecha, inventario["id"], f"Transformación {numero}", total_entrada, trans_id))
-                cur.execute("""
-                    INSERT INTO movimientos_contables (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
-                    VALUES (?, ?, ?, 0, ?, 'transformacion', ?)
-                """, (fecha, inventario["id"], f"Transformación {numero}", total_salida, trans_id))
-                conn.commit()
-            conn.close()
-        except Exception as e:
-            print("Error asiento transformación:", e)
+            # Registrar asiento contable 1435 contra 1435
+            contabilizar(cur, "transformacion", trans_id, numero, fecha, total_entrada, total_salida)
 
         return jsonify({"success": True, "mensaje": f"Transformación #{numero} registrada"})
+    except ConflictoStock as e:
+        return jsonify(e.respuesta()), 409
     except Exception as e:
         print("Error save_transformacion:", e)
         return jsonify({"success": False, "error": str(e)})
@@ -784,13 +2075,22 @@ def add_tercero():
         cur = conn.cursor()
         cur.execute("INSERT INTO terceros (nombres, apellidos, telefono, correo, direccion, tipo) VALUES (?, ?, ?, ?, ?, ?)",
                     (nombres, apellidos, telefono, correo, direccion, tipo))
-        conn.commit()
         tercero_id = cur.lastrowid
+        tocar_catalogo(cur, "terceros")
+        conn.commit()
         conn.close()
         return jsonify({"success": True, "id": tercero_id, "nombre": f"{nombres} {apellidos}"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/api/terceros")
+def api_terceros():
+    """Terceros para los desplegables (?tipo=Cliente|Proveedor)."""
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    tipo = request.args.get("tipo") or None
+    return respuesta_catalogo("terceros", tipo or "todos", _terceros(tipo))
+
 # =========================
 # GASTOS (vista)
 # =========================
@@ -810,36 +2110,34 @@ def recibo_caja():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        terceros = cur.execute("SELECT id, nombres || ' ' || IFNULL(apellidos,'') as nombre FROM terceros").fetchall()
+        terceros = terceros_catalogo(cur)
     except Exception:
         terceros = []
     try:
-        cur.execute("SELECT MAX(numero) FROM recibos_caja")
-        last_num = cur.fetchone()[0] or 0
+        numero = proximo_numero(cur, "recibos_caja")
     except Exception:
-        last_num = 0
+        numero = 1
     conn.close()
-    return render_template("recibo_caja.html", user=session["user"], clientes=terceros, numero=last_num + 1, fecha=datetime.now().strftime("%Y-%m-%d"))
+    return render_template("recibo_caja.html", user=session["user"], clientes=terceros, numero=numero, fecha=datetime.now().strftime("%Y-%m-%d"))
 
 @app.route("/recibo_caja/save", methods=["POST"])
+@idempotente
 def recibo_caja_save():
     if "user" not in session:
         return jsonify({"success": False, "error": "No autorizado"})
     data = request.get_json()
     try:
         tercero_id = data.get("tercero_id")
-        numero = data.get("numero")
         fecha = data.get("fecha") or datetime.now().strftime("%Y-%m-%d")
         concepto = data.get("concepto")
         valor = float(data.get("valor"))
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO recibos_caja (numero, fecha, tercero_id, concepto, valor) VALUES (?, ?, ?, ?, ?)",
-                    (numero, fecha, tercero_id, concepto, valor))
-        recibo_id = cur.lastrowid
-        conn.commit()
-        conn.close()
-        crear_asiento_recibo(recibo_id)
+        with transaccion() as cur:
+            numero = siguiente_numero(cur, "recibos_caja")
+            cur.execute("INSERT INTO recibos_caja (numero, fecha, tercero_id, concepto, valor) VALUES (?, ?, ?, ?, ?)",
+                        (numero, fecha, tercero_id, concepto, valor))
+            recibo_id = cur.lastrowid
+            acumular_caja(cur, "recibo", valor)
+            contabilizar(cur, "recibo", recibo_id, numero, fecha, valor, concepto)
         return jsonify({"success": True, "recibo_num": numero})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -852,18 +2150,13 @@ def api_recibos_lista():
     fecha_inicio = data.get("fecha_inicio")
     fecha_fin = data.get("fecha_fin")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        recibos = cur.execute("""
+        return responder_lista("recibos", """
             SELECT r.id, r.numero, r.fecha, r.concepto, r.valor,
                    t.nombres || ' ' || IFNULL(t.apellidos,'') as tercero
             FROM recibos_caja r
             LEFT JOIN terceros t ON r.tercero_id = t.id
-            WHERE r.fecha BETWEEN ? AND ?
-            ORDER BY r.fecha DESC, r.numero DESC
-        """, (fecha_inicio, fecha_fin)).fetchall()
-        conn.close()
-        return jsonify({"success": True, "recibos": [dict(row) for row in recibos]})
+            WHERE r.fecha BETWEEN ? AND {hasta} {despues}
+        """, (fecha_inicio, fecha_fin), "r", data)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -877,36 +2170,34 @@ def comprobante_egreso():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        terceros = cur.execute("SELECT id, nombres || ' ' || IFNULL(apellidos,'') as nombre FROM terceros").fetchall()
+        terceros = terceros_catalogo(cur)
     except Exception:
         terceros = []
     try:
-        cur.execute("SELECT MAX(numero) FROM comprobantes_egreso")
-        last_num = cur.fetchone()[0] or 0
+        numero = proximo_numero(cur, "comprobantes_egreso")
     except Exception:
-        last_num = 0
+        numero = 1
     conn.close()
-    return render_template("comprobante_egreso.html", user=session["user"], terceros=terceros, numero=last_num + 1, fecha=datetime.now().strftime("%Y-%m-%d"))
+    return render_template("comprobante_egreso.html", user=session["user"], terceros=terceros, numero=numero, fecha=datetime.now().strftime("%Y-%m-%d"))
 
 @app.route("/comprobante_egreso/save", methods=["POST"])
+@idempotente
 def comprobante_egreso_save():
     if "user" not in session:
         return jsonify({"success": False, "error": "No autorizado"})
     data = request.get_json()
     try:
         tercero_id = data.get("tercero_id")
-        numero = data.get("numero")
         fecha = data.get("fecha") or datetime.now().strftime("%Y-%m-%d")
         concepto = data.get("concepto")
         valor = float(data.get("valor"))
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO comprobantes_egreso (numero, fecha, tercero_id, concepto, valor) VALUES (?, ?, ?, ?, ?)",
-                    (numero, fecha, tercero_id, concepto, valor))
-        egreso_id = cur.lastrowid
-        conn.commit()
-        conn.close()
-        crear_asiento_egreso(egreso_id)
+        with transaccion() as cur:
+            numero = siguiente_numero(cur, "comprobantes_egreso")
+            cur.execute("INSERT INTO comprobantes_egreso (numero, fecha, tercero_id, concepto, valor) VALUES (?, ?, ?, ?, ?)",
+                        (numero, fecha, tercero_id, concepto, valor))
+            egreso_id = cur.lastrowid
+            acumular_caja(cur, "egreso", valor)
+            contabilizar(cur, "egreso", egreso_id, numero, fecha, valor, concepto)
         return jsonify({"success": True, "egreso_num": numero})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -919,18 +2210,87 @@ def api_egresos_lista():
     fecha_inicio = data.get("fecha_inicio")
     fecha_fin = data.get("fecha_fin")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        egresos = cur.execute("""
+        return responder_lista("egresos", """
             SELECT e.id, e.numero, e.fecha, e.concepto, e.valor,
                    t.nombres || ' ' || IFNULL(t.apellidos,'') as tercero
             FROM comprobantes_egreso e
             LEFT JOIN terceros t ON e.tercero_id = t.id
-            WHERE e.fecha BETWEEN ? AND ?
-            ORDER BY e.fecha DESC, e.numero DESC
-        """, (fecha_inicio, fecha_fin)).fetchall()
-        conn.close()
-        return jsonify({"success": True, "egresos": [dict(row) for row in egresos]})
+            WHERE e.fecha BETWEEN ? AND {hasta} {despues}
+        """, (fecha_inicio, fecha_fin), "e", data)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+# =========================
+# CAJA (sesiones y cierre)
+# =========================
+def _sesion_caja(cur, sesion_id=None):
+    sql = f"SELECT *, {CAJA_ESPERADO} AS esperado_actual FROM sesiones_caja"
+    if sesion_id is None:
+        return cur.execute(sql + " WHERE usuario = ? AND cerrada IS NULL", (session["user"],)).fetchone()
+    return cur.execute(sql + " WHERE id = ?", (sesion_id,)).fetchone()
+
+@app.route("/api/caja/sesion")
+def api_caja_sesion():
+    """Sesión abierta del usuario con sus totales en vivo (una fila)."""
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    try:
+        row = _sesion_caja(get_db_connection().cursor())
+        return jsonify({"success": True, "sesion": dict(row) if row else None})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/api/caja/sesion/<int:sesion_id>")
+def api_caja_sesion_detalle(sesion_id):
+    """Reporte de cierre de una sesión (propia, o cualquiera para admin)."""
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    try:
+        row = _sesion_caja(get_db_connection().cursor(), sesion_id)
+        if not row or (row["usuario"] != session["user"] and session.get("rol") != "admin"):
+            return jsonify({"success": False, "error": "Sesión no encontrada"})
+        return jsonify({"success": True, "sesion": dict(row)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/api/caja/sesion/abrir", methods=["POST"])
+def api_caja_abrir():
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    data = request.get_json() or {}
+    try:
+        base = float(data.get("base") or 0)
+        with transaccion() as cur:
+            if _sesion_caja(cur):
+                return jsonify({"success": False, "error": "Ya hay una sesión de caja abierta"})
+            cur.execute("INSERT INTO sesiones_caja (usuario, base) VALUES (?, ?)", (session["user"], base))
+            row = _sesion_caja(cur, cur.lastrowid)
+        return jsonify({"success": True, "sesion": dict(row)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/api/caja/sesion/cerrar", methods=["POST"])
+def api_caja_cerrar():
+    """Cierra la sesión abierta: fija el esperado y la diferencia contra el efectivo contado."""
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    data = request.get_json() or {}
+    try:
+        if data.get("contado") in (None, ""):
+            return jsonify({"success": False, "error": "Efectivo contado requerido"})
+        contado = float(data.get("contado"))
+        with transaccion() as cur:
+            row = cur.execute(f"""
+                UPDATE sesiones_caja
+                SET cerrada = datetime('now'), esperado = {CAJA_ESPERADO}, contado = ?,
+                    diferencia = ? - ({CAJA_ESPERADO}), observaciones = ?
+                WHERE usuario = ? AND cerrada IS NULL
+                RETURNING id
+            """, (contado, contado, data.get("observaciones"), session["user"])).fetchone()
+            if row is None:
+                return jsonify({"success": False, "error": "No hay una sesión de caja abierta"})
+            sesion = _sesion_caja(cur, row["id"])
+        return jsonify({"success": True, "sesion": dict(sesion)})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -950,7 +2310,7 @@ def puc():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        cuentas = cur.execute("SELECT codigo, nombre, tipo FROM puc ORDER BY codigo").fetchall()
+        cuentas = leer_catalogo(cur, "puc", "todas", _cuentas_puc)[1]
     except Exception:
         cuentas = []
     conn.close()
@@ -964,6 +2324,12 @@ def movimientos():
     first_day_month = datetime.now().replace(day=1).strftime("%Y-%m-%d")
     return render_template("movimientos.html", user=session["user"], fecha_inicio=first_day_month, fecha_fin=today)
 
+@app.route("/api/puc")
+def api_puc():
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    return respuesta_catalogo("puc", "todas", _cuentas_puc)
+
 @app.route("/api/puc/add", methods=["POST"])
 def add_cuenta():
     if "user" not in session:
@@ -978,14 +2344,39 @@ def add_cuenta():
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute("INSERT INTO puc (codigo, nombre, tipo) VALUES (?, ?, ?)", (codigo, nombre, tipo))
+        tocar_catalogo(cur, "puc")
         conn.commit()
         conn.close()
+        invalidar_cache_puc()
         return jsonify({"success": True, "mensaje": f"Cuenta {codigo} agregada correctamente"})
     except sqlite3.IntegrityError:
         return jsonify({"success": False, "error": "El código de cuenta ya existe"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/api/contabilidad/pendientes")
+def api_asientos_pendientes():
+    """Estado de la cola de asientos: cuántos esperan, cuántos fallaron y el atraso."""
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    cur = get_db_connection().cursor()
+    try:
+        row = cur.execute("""
+            SELECT SUM(intentos < :max) AS pendientes,
+                   SUM(intentos >= :max) AS fallidos,
+                   (julianday('now') - julianday(MIN(CASE WHEN intentos < :max THEN creado END))) * 86400 AS atraso
+            FROM asientos_pendientes
+        """, {"max": ASIENTOS_MAX_INTENTOS}).fetchone()
+        errores = [dict(r) for r in cur.execute("""
+            SELECT id, tipo, referencia_id, intentos, error, creado FROM asientos_pendientes
+            WHERE error IS NOT NULL ORDER BY id LIMIT 20
+        """)]
+        return jsonify({"success": True, "diferida": CONTABILIDAD_DIFERIDA,
+                        "pendientes": row["pendientes"] or 0, "fallidos": row["fallidos"] or 0,
+                        "atraso_segundos": round(row["atraso"] or 0, 1), "errores": errores})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
 @app.route("/api/movimientos", methods=["POST"])
 def get_movimientos():
     if "user" not in session:
@@ -994,17 +2385,12 @@ def get_movimientos():
     fecha_inicio = data.get("fecha_inicio")
     fecha_fin = data.get("fecha_fin")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        movimientos = cur.execute("""
-            SELECT m.fecha, m.descripcion, p.codigo, p.nombre, m.debito, m.credito, m.modulo, m.referencia_id
+        return responder_lista("movimientos", """
+            SELECT m.id, m.fecha, m.descripcion, p.codigo, p.nombre, m.debito, m.credito, m.modulo, m.referencia_id
             FROM movimientos_contables m
             JOIN puc p ON m.cuenta_id = p.id
-            WHERE m.fecha BETWEEN ? AND ?
-            ORDER BY m.fecha DESC, m.id DESC
-        """, (fecha_inicio, fecha_fin)).fetchall()
-        conn.close()
-        return jsonify({"success": True, "movimientos": [dict(row) for row in movimientos]})
+            WHERE m.fecha BETWEEN ? AND {hasta} {despues}
+        """, (fecha_inicio, fecha_fin), "m", data)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -1017,17 +2403,18 @@ def get_balance():
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        # Último saldo acumulado de cada cuenta hasta fecha_fin (una búsqueda por cuenta)
         balance = cur.execute("""
             SELECT p.codigo, p.nombre, p.tipo,
-                   SUM(m.debito) as total_debito,
-                   SUM(m.credito) as total_credito,
-                   CASE WHEN p.tipo IN ('activo', 'gasto') THEN SUM(m.debito) - SUM(m.credito)
-                        ELSE SUM(m.credito) - SUM(m.debito)
+                   s.debito_acum as total_debito,
+                   s.credito_acum as total_credito,
+                   CASE WHEN p.tipo IN ('activo', 'gasto') THEN s.debito_acum - s.credito_acum
+                        ELSE s.credito_acum - s.debito_acum
                    END as saldo
             FROM puc p
-            LEFT JOIN movimientos_contables m ON p.id = m.cuenta_id AND m.fecha <= ?
-            GROUP BY p.id, p.codigo, p.nombre, p.tipo
-            HAVING SUM(COALESCE(m.debito,0)) > 0 OR SUM(COALESCE(m.credito,0)) > 0
+            JOIN saldos_diarios s ON s.cuenta_id = p.id
+             AND s.fecha = (SELECT MAX(fecha) FROM saldos_diarios WHERE cuenta_id = p.id AND fecha <= ?)
+            WHERE s.debito_acum > 0 OR s.credito_acum > 0
             ORDER BY p.codigo
         """, (fecha_fin,)).fetchall()
         conn.close()
@@ -1064,8 +2451,10 @@ def seed_puc():
         cur = conn.cursor()
         for codigo, nombre, tipo in cuentas_basicas:
             cur.execute("INSERT OR IGNORE INTO puc (codigo, nombre, tipo) VALUES (?, ?, ?)", (codigo, nombre, tipo))
+        tocar_catalogo(cur, "puc")
         conn.commit()
         conn.close()
+        invalidar_cache_puc()
         return jsonify({"success": True, "mensaje": "PUC inicializado correctamente"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -1090,29 +2479,27 @@ def api_resumen_ventas():
     fecha_fin = data.get("fecha_fin")
     try:
         conn = get_db_connection(); cur = conn.cursor()
+        # Solo lee los resúmenes diarios (un registro por día / producto / cliente)
         ventas_diarias = cur.execute("""
-            SELECT DATE(fecha) as dia, COUNT(*) as num_facturas, SUM(total) as total_ventas
-            FROM facturas WHERE fecha BETWEEN ? AND ? GROUP BY DATE(fecha) ORDER BY dia
+            SELECT fecha as dia, num_documentos as num_facturas, total as total_ventas
+            FROM resumen_ventas_dia WHERE fecha BETWEEN ? AND ? ORDER BY fecha
         """, (fecha_inicio, fecha_fin)).fetchall()
         total_periodo = cur.execute("""
-            SELECT COUNT(*) as facturas, SUM(total) as total, AVG(total) as promedio
-            FROM facturas WHERE fecha BETWEEN ? AND ?
-        """, (fecha_inicio, fecha_fin)).fetchone()
-        producto_top = cur.execute("""
-            SELECT p.nombre, SUM(df.cantidad) as cantidad_vendida, SUM(df.total) as ingresos_producto
-            FROM detalle_factura df JOIN productos p ON df.producto_id = p.id
-            JOIN facturas f ON df.factura_id = f.id
-            WHERE f.fecha BETWEEN ? AND ? GROUP BY p.id, p.nombre ORDER BY cantidad_vendida DESC LIMIT 1
+            SELECT IFNULL(SUM(num_documentos), 0) as facturas, SUM(total) as total,
+                   SUM(total) / NULLIF(SUM(num_documentos), 0) as promedio
+            FROM resumen_ventas_dia WHERE fecha BETWEEN ? AND ?
         """, (fecha_inicio, fecha_fin)).fetchone()
         top_productos = cur.execute("""
-            SELECT p.nombre, SUM(df.cantidad) as cantidad_vendida, SUM(df.total) as ingresos_producto, COUNT(DISTINCT f.id) as facturas_aparece
-            FROM detalle_factura df JOIN productos p ON df.producto_id = p.id JOIN facturas f ON df.factura_id = f.id
-            WHERE f.fecha BETWEEN ? AND ? GROUP BY p.id, p.nombre ORDER BY cantidad_vendida DESC LIMIT 5
+            SELECT p.nombre, SUM(r.cantidad) as cantidad_vendida, SUM(r.total) as ingresos_producto, SUM(r.num_documentos) as facturas_aparece
+            FROM resumen_ventas_producto r JOIN productos p ON r.producto_id = p.id
+            WHERE r.fecha BETWEEN ? AND ? GROUP BY p.id, p.nombre ORDER BY cantidad_vendida DESC LIMIT 5
         """, (fecha_inicio, fecha_fin)).fetchall()
+        producto_top = ({k: top_productos[0][k] for k in ("nombre", "cantidad_vendida", "ingresos_producto")}
+                        if top_productos else None)
         cliente_top = cur.execute("""
-            SELECT t.nombres || ' ' || IFNULL(t.apellidos,'') as cliente, COUNT(*) as num_compras, SUM(f.total) as total_comprado
-            FROM facturas f JOIN terceros t ON f.tercero_id = t.id
-            WHERE f.fecha BETWEEN ? AND ? GROUP BY t.id, cliente ORDER BY total_comprado DESC LIMIT 1
+            SELECT t.nombres || ' ' || IFNULL(t.apellidos,'') as cliente, SUM(r.num_documentos) as num_compras, SUM(r.total) as total_comprado
+            FROM resumen_ventas_tercero r JOIN terceros t ON r.tercero_id = t.id
+            WHERE r.fecha BETWEEN ? AND ? GROUP BY t.id, cliente ORDER BY total_comprado DESC LIMIT 1
         """, (fecha_inicio, fecha_fin)).fetchone()
         conn.close()
         return jsonify({"success": True,
@@ -1133,25 +2520,26 @@ def api_resumen_compras():
     fecha_fin = data.get("fecha_fin")
     try:
         conn = get_db_connection(); cur = conn.cursor()
+        # Solo lee los resúmenes diarios (un registro por día / producto / proveedor)
         compras_diarias = cur.execute("""
-            SELECT DATE(fecha) as dia, COUNT(*) as num_compras, SUM(total) as total_compras
-            FROM compras WHERE fecha BETWEEN ? AND ? GROUP BY DATE(fecha) ORDER BY dia
+            SELECT fecha as dia, num_documentos as num_compras, total as total_compras
+            FROM resumen_compras_dia WHERE fecha BETWEEN ? AND ? ORDER BY fecha
         """, (fecha_inicio, fecha_fin)).fetchall()
         total_compras = cur.execute("""
-            SELECT COUNT(*) as compras, SUM(total) as total, AVG(total) as promedio,
-                   SUM(CASE WHEN pagada = 1 THEN total ELSE 0 END) as pagadas,
-                   SUM(CASE WHEN pagada = 0 THEN total ELSE 0 END) as pendientes
-            FROM compras WHERE fecha BETWEEN ? AND ?
+            SELECT IFNULL(SUM(num_documentos), 0) as compras, SUM(total) as total,
+                   SUM(total) / NULLIF(SUM(num_documentos), 0) as promedio,
+                   SUM(pagadas) as pagadas, SUM(pendientes) as pendientes
+            FROM resumen_compras_dia WHERE fecha BETWEEN ? AND ?
         """, (fecha_inicio, fecha_fin)).fetchone()
         proveedor_top = cur.execute("""
-            SELECT t.nombres || ' ' || IFNULL(t.apellidos,'') as proveedor, COUNT(*) as num_compras, SUM(c.total) as total_comprado
-            FROM compras c JOIN terceros t ON c.tercero_id = t.id
-            WHERE c.fecha BETWEEN ? AND ? GROUP BY t.id, proveedor ORDER BY total_comprado DESC LIMIT 1
+            SELECT t.nombres || ' ' || IFNULL(t.apellidos,'') as proveedor, SUM(r.num_documentos) as num_compras, SUM(r.total) as total_comprado
+            FROM resumen_compras_tercero r JOIN terceros t ON r.tercero_id = t.id
+            WHERE r.fecha BETWEEN ? AND ? GROUP BY t.id, proveedor ORDER BY total_comprado DESC LIMIT 1
         """, (fecha_inicio, fecha_fin)).fetchone()
         productos_comprados = cur.execute("""
-            SELECT p.nombre, SUM(dc.cantidad) as cantidad_comprada, SUM(dc.total) as total_invertido, COUNT(DISTINCT c.id) as compras_aparece
-            FROM detalle_compra dc JOIN productos p ON dc.producto_id = p.id JOIN compras c ON dc.compra_id = c.id
-            WHERE c.fecha BETWEEN ? AND ? GROUP BY p.id, p.nombre ORDER BY cantidad_comprada DESC LIMIT 5
+            SELECT p.nombre, SUM(r.cantidad) as cantidad_comprada, SUM(r.total) as total_invertido, SUM(r.num_documentos) as compras_aparece
+            FROM resumen_compras_producto r JOIN productos p ON r.producto_id = p.id
+            WHERE r.fecha BETWEEN ? AND ? GROUP BY p.id, p.nombre ORDER BY cantidad_comprada DESC LIMIT 5
         """, (fecha_inicio, fecha_fin)).fetchall()
         conn.close()
         return jsonify({"success": True,
@@ -1170,14 +2558,11 @@ def api_facturas_lista():
     fecha_inicio = data.get("fecha_inicio")
     fecha_fin = data.get("fecha_fin")
     try:
-        conn = get_db_connection(); cur = conn.cursor()
-        facturas = cur.execute("""
+        return responder_lista("facturas", """
             SELECT f.id, f.numero, f.fecha, f.total, t.nombres || ' ' || IFNULL(t.apellidos,'') as cliente
             FROM facturas f LEFT JOIN terceros t ON f.tercero_id = t.id
-            WHERE f.fecha BETWEEN ? AND ? ORDER BY f.fecha DESC, f.numero DESC
-        """, (fecha_inicio, fecha_fin)).fetchall()
-        conn.close()
-        return jsonify({"success": True, "facturas": [dict(r) for r in facturas]})
+            WHERE f.fecha BETWEEN ? AND {hasta} {despues}
+        """, (fecha_inicio, fecha_fin), "f", data)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -1189,14 +2574,11 @@ def api_compras_lista():
     fecha_inicio = data.get("fecha_inicio")
     fecha_fin = data.get("fecha_fin")
     try:
-        conn = get_db_connection(); cur = conn.cursor()
-        compras = cur.execute("""
+        return responder_lista("compras", """
             SELECT c.id, c.numero, c.fecha, c.total, c.forma_pago, c.pagada, t.nombres || ' ' || IFNULL(t.apellidos,'') as proveedor
             FROM compras c LEFT JOIN terceros t ON c.tercero_id = t.id
-            WHERE c.fecha BETWEEN ? AND ? ORDER BY c.fecha DESC, c.numero DESC
-        """, (fecha_inicio, fecha_fin)).fetchall()
-        conn.close()
-        return jsonify({"success": True, "compras": [dict(r) for r in compras]})
+            WHERE c.fecha BETWEEN ? AND {hasta} {despues}
+        """, (fecha_inicio, fecha_fin), "c", data)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -1245,6 +2627,244 @@ def api_compra_detalle(compra_id):
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+# =========================
+# EXPORTACIÓN (CSV / NDJSON en streaming, para el contador)
+# =========================
+# Cada exportación es una sola consulta ordenada por fecha e id (y las líneas
+# de cada documento por su id, contiguas). El orden es el de los índices
+# (fecha, id) y el de detalle por documento, así que SQLite no ordena en un
+# B-tree temporal (benchmark.verificar_planes lo comprueba). Las filas se
+# leen del cursor una a una y salen en bloques de EXPORT_BLOQUE, comprimidos
+# con gzip al vuelo si se pide, así que la memoria no depende del rango.
+EXPORT_BLOQUE = 64 * 1024
+
+EXPORTACIONES = {
+    "movimientos": """
+        SELECT m.id, m.fecha, p.codigo AS cuenta, p.nombre AS nombre_cuenta, m.descripcion,
+               m.debito, m.credito, m.modulo, m.referencia_id
+        FROM movimientos_contables m JOIN puc p ON m.cuenta_id = p.id
+        WHERE m.fecha BETWEEN ? AND ? ORDER BY m.fecha, m.id
+    """,
+    "facturas": """
+        SELECT f.id AS factura_id, f.numero, f.fecha, t.nombres || ' ' || IFNULL(t.apellidos,'') AS cliente,
+               f.total AS total_factura, p.nombre AS producto, df.cantidad, df.precio, df.total
+        FROM facturas f
+        LEFT JOIN terceros t ON f.tercero_id = t.id
+        LEFT JOIN detalle_factura df ON df.factura_id = f.id
+        LEFT JOIN productos p ON df.producto_id = p.id
+        WHERE f.fecha BETWEEN ? AND ? ORDER BY f.fecha, f.id, df.id
+    """,
+    "compras": """
+        SELECT c.id AS compra_id, c.numero, c.fecha, t.nombres || ' ' || IFNULL(t.apellidos,'') AS proveedor,
+               c.forma_pago, c.pagada, c.total AS total_compra, p.nombre AS producto, dc.cantidad, dc.costo, dc.total
+        FROM compras c
+        LEFT JOIN terceros t ON c.tercero_id = t.id
+        LEFT JOIN detalle_compra dc ON dc.compra_id = c.id
+        LEFT JOIN productos p ON dc.producto_id = p.id
+        WHERE c.fecha BETWEEN ? AND ? ORDER BY c.fecha, c.id, dc.id
+    """,
+}
+
+def _bloques_csv(cur, separador):
+    buf = io.StringIO()
+    buf.write("\ufeff")  # BOM: Excel abre el archivo como UTF-8
+    escritor = csv.writer(buf, delimiter=separador, lineterminator="\r\n")
+    escritor.writerow([c[0] for c in cur.description])
+    for row in cur:
+        escritor.writerow(tuple(row))
+        if buf.tell() >= EXPORT_BLOQUE:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+def _bloques_ndjson(cur):
+    lineas, tam = [], 0
+    for row in cur:
+        linea = json.dumps(dict(row), ensure_ascii=False) + "\n"
+        lineas.append(linea); tam += len(linea)
+        if tam >= EXPORT_BLOQUE:
+            yield "".join(lineas)
+            lineas, tam = [], 0
+    yield "".join(lineas)
+
+def _gzip(bloques):
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for bloque in bloques:
+        datos = comp.compress(bloque.encode("utf-8"))
+        if datos:
+            yield datos
+    yield comp.flush()
+
+@app.route("/api/exportar/<tipo>")
+def api_exportar(tipo):
+    """GET /api/exportar/<movimientos|facturas|compras>?fecha_inicio=&fecha_fin=
+
+    formato=csv (por defecto; separador=, o ;) o ndjson; gzip=1 descarga
+    el archivo .gz. Sin gzip=1, si el cliente acepta gzip se comprime igual
+    como Content-Encoding.
+    """
+    if "user" not in session:
+        return jsonify({"success": False, "error": "No autorizado"})
+    if tipo not in EXPORTACIONES:
+        return jsonify({"success": False, "error": f"Tipo de exportación desconocido: {tipo}"})
+    fecha_inicio = request.args.get("fecha_inicio")
+    fecha_fin = request.args.get("fecha_fin")
+    formato = request.args.get("formato", "csv")
+    separador = request.args.get("separador", ",")
+    if not fecha_inicio or not fecha_fin:
+        return jsonify({"success": False, "error": "fecha_inicio y fecha_fin son requeridas"})
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"success": False, "error": "formato debe ser csv o ndjson"})
+    if separador not in (",", ";"):
+        return jsonify({"success": False, "error": "separador debe ser , o ;"})
+    try:
+        cur = get_db_connection().cursor()
+        cur.execute(EXPORTACIONES[tipo], (fecha_inicio, fecha_fin))
+        if formato == "csv":
+            bloques, mimetype = _bloques_csv(cur, separador), "text/csv; charset=utf-8"
+        else:
+            bloques, mimetype = _bloques_ndjson(cur), "application/x-ndjson"
+        nombre = f"{tipo}_{fecha_inicio}_{fecha_fin}.{formato}"
+        headers = {}
+        if request.args.get("gzip") in ("1", "true"):
+            bloques, mimetype, nombre = _gzip(bloques), "application/gzip", nombre + ".gz"
+        elif "gzip" in request.headers.get("Accept-Encoding", ""):
+            bloques = _gzip(bloques)
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+        headers["Content-Disposition"] = f'attachment; filename="{nombre}"'
+        return Response(stream_with_context(bloques), mimetype=mimetype, headers=headers)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+# =========================
+# MÉTRICAS (/metrics, formato de texto de Prometheus)
+# =========================
+# Cada worker acumula en memoria y cada METRICAS_FLUSH segundos suma sus
+# deltas a un SQLite aparte (POS_METRICAS_DB), que es lo que lee /metrics;
+# así el total es el de todos los workers de gunicorn. Se cuentan como
+# error los 5xx y las respuestas JSON con "success": false, que los
+# handlers devuelven con estado 200.
+METRICAS_DB = os.environ.get("POS_METRICAS_DB", "metricas.db")
+METRICAS_TOKEN = os.environ.get("POS_METRICAS_TOKEN")
+METRICAS_FLUSH = 5.0
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_metricas = defaultdict(float)          # (nombre, etiquetas) -> delta sin guardar
+_metricas_lock = threading.Lock()
+_metricas_conn = None
+_metricas_pid = None
+_metricas_ultimo_flush = 0.0
+
+def _conexion_metricas():
+    global _metricas_conn, _metricas_pid
+    if _metricas_pid != os.getpid():
+        _metricas_conn = sqlite3.connect(METRICAS_DB, check_same_thread=False, timeout=5)
+        _metricas_conn.execute("PRAGMA journal_mode=WAL")
+        _metricas_conn.execute("PRAGMA synchronous=OFF")
+        _metricas_conn.execute("""
+            CREATE TABLE IF NOT EXISTS metricas (
+                nombre TEXT NOT NULL,
+                etiquetas TEXT NOT NULL,
+                valor REAL NOT NULL,
+                PRIMARY KEY (nombre, etiquetas)
+            ) WITHOUT ROWID
+        """)
+        _metricas_pid = os.getpid()
+    return _metricas_conn
+
+def _observar(nombre, etiquetas, segundos):
+    """Suma una observación al histograma nombre{etiquetas}."""
+    for le in METRICAS_BUCKETS:
+        if segundos <= le:
+            _metricas[(nombre + "_bucket", f'{etiquetas},le="{le}"')] += 1
+    _metricas[(nombre + "_bucket", f'{etiquetas},le="+Inf"')] += 1
+    _metricas[(nombre + "_sum", etiquetas)] += segundos
+    _metricas[(nombre + "_count", etiquetas)] += 1
+
+def guardar_metricas(forzar=False):
+    global _metricas_ultimo_flush
+    ahora = time.monotonic()
+    if not forzar and ahora - _metricas_ultimo_flush < METRICAS_FLUSH:
+        return
+    with _metricas_lock:
+        _metricas_ultimo_flush = ahora
+        deltas = list(_metricas.items())
+        _metricas.clear()
+        if not deltas:
+            return
+        conn = _conexion_metricas()
+        try:
+            conn.executemany("""
+                INSERT INTO metricas (nombre, etiquetas, valor) VALUES (?, ?, ?)
+                ON CONFLICT(nombre, etiquetas) DO UPDATE SET valor = valor + excluded.valor
+            """, [(nombre, etiquetas, valor) for (nombre, etiquetas), valor in deltas])
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            for clave, valor in deltas:
+                _metricas[clave] += valor
+            print("Error guardando métricas:", e)
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_request = time.perf_counter()
+
+@app.after_request
+def registrar_metricas(response):
+    inicio = g.pop("inicio_request", None)
+    if inicio is None:
+        return response
+    segundos = time.perf_counter() - inicio
+    endpoint = request.endpoint or "sin_ruta"
+    etiquetas = f'endpoint="{endpoint}"'
+    error = response.status_code >= 500
+    if not error and response.mimetype == "application/json" and not response.is_streamed:
+        cuerpo = response.get_data()
+        error = b'"success":false' in cuerpo or b'"success": false' in cuerpo
+    with _metricas_lock:
+        _metricas[("pos_requests_total", f'{etiquetas},method="{request.method}",status="{response.status_code}"')] += 1
+        if error:
+            _metricas[("pos_request_errors_total", etiquetas)] += 1
+        _observar("pos_request_duration_seconds", etiquetas, segundos)
+        if g.get("sql_consultas"):
+            _observar("pos_db_duration_seconds", etiquetas, g.sql_ms / 1000)
+            _metricas[("pos_db_queries_total", etiquetas)] += g.sql_consultas
+    guardar_metricas()
+    return response
+
+@app.route("/metrics")
+def metrics():
+    if METRICAS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICAS_TOKEN}":
+        return Response("No autorizado\n", status=401, mimetype="text/plain")
+    guardar_metricas(forzar=True)
+    with _metricas_lock:
+        filas = _conexion_metricas().execute(
+            "SELECT nombre, etiquetas, valor FROM metricas ORDER BY nombre, etiquetas").fetchall()
+
+    tipos = {"pos_requests_total": "counter", "pos_request_errors_total": "counter",
+             "pos_db_queries_total": "counter", "pos_request_duration_seconds": "histogram",
+             "pos_db_duration_seconds": "histogram"}
+    lineas, declaradas = [], set()
+    for nombre, etiquetas, valor in filas:
+        base = re.sub(r"_(bucket|sum|count)$", "", nombre) if nombre.endswith(("_bucket", "_sum", "_count")) else nombre
+        if base not in declaradas:
+            lineas.append(f"# TYPE {base} {tipos.get(base, 'untyped')}")
+            declaradas.add(base)
+        lineas.append(f"{nombre}{{{etiquetas}}} {valor:g}")
+
+    # Gauges: se leen de la base del POS en el momento del scrape
+    cur = get_db_connection().cursor()
+    inventario = cur.execute("SELECT IFNULL(SUM(stock * costo), 0) AS valor FROM productos").fetchone()["valor"]
+    cola = cur.execute("""
+        SELECT COUNT(*) AS pendientes,
+               IFNULL((julianday('now') - julianday(MIN(creado))) * 86400, 0) AS atraso
+        FROM asientos_pendientes WHERE intentos < ?
+    """, (ASIENTOS_MAX_INTENTOS,)).fetchone()
+    lineas += ["# TYPE pos_inventario_valor gauge", f"pos_inventario_valor {inventario:g}",
+               "# TYPE pos_asientos_pendientes gauge", f"pos_asientos_pendientes {cola['pendientes']}",
+               "# TYPE pos_asientos_atraso_segundos gauge", f"pos_asientos_atraso_segundos {cola['atraso']:.1f}"]
+    return Response("\n".join(lineas) + "\n", mimetype="text/plain; version=0.0.4")
+
 # =========================
 # AJUSTES (USUARIOS / CONFIG)
 # =========================
@@ -1306,6 +2926,39 @@ def toggle_usuario(user_id):
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/ajustes/sql")
+def ajustes_sql():
+    """Perfil SQL del proceso: sentencias más costosas, consultas por endpoint y registro de lentas."""
+    if "user" not in session or session.get("rol") != "admin":
+        return jsonify({"success": False, "error": "No autorizado"}), 403
+    limite = request.args.get("limit", 50, type=int)
+    with _perfil_lock:
+        sentencias = sorted(_perfil_sentencias.items(), key=lambda kv: kv[1][1], reverse=True)[:limite]
+        endpoints = sorted(_perfil_endpoints.items(), key=lambda kv: kv[1][2], reverse=True)
+        lentas = list(_sql_lentas)[::-1]
+    return jsonify({
+        "success": True,
+        "pid": os.getpid(),
+        "umbral_ms": SQL_LENTO_MS,
+        "sentencias": [{"sql": sql, "veces": n, "total_ms": round(total, 2),
+                        "promedio_ms": round(total / n, 3), "max_ms": round(maximo, 2)}
+                       for sql, (n, total, maximo) in sentencias],
+        "endpoints": [{"endpoint": ep, "requests": n, "consultas_promedio": round(consultas / n, 2),
+                       "consultas_max": maximo, "sql_ms_promedio": round(total / n, 3)}
+                      for ep, (n, consultas, total, maximo) in endpoints],
+        "lentas": lentas,
+    })
+
+@app.route("/ajustes/sql/reset", methods=["POST"])
+def ajustes_sql_reset():
+    if "user" not in session or session.get("rol") != "admin":
+        return jsonify({"success": False, "error": "No autorizado"}), 403
+    with _perfil_lock:
+        _perfil_sentencias.clear()
+        _perfil_endpoints.clear()
+        _sql_lentas.clear()
+    return jsonify({"success": True})
+
 # =========================
 # INICIO
 # =========================
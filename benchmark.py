@@ -0,0 +1,432 @@
+# benchmark.py
+# Mide latencia (p50/p95/p99) y requests por segundo de los caminos de cobro
+# y de reportes sobre una base sintética.
+#
+#   python benchmark.py --anios 2 --facturas-dia 80 --concurrencia 8
+#   python benchmark.py --gunicorn 4 --salida resultado.json
+#   python benchmark.py --url http://127.0.0.1:8000
+#
+# Con --url no se toca ninguna base local: los ids de productos y terceros y
+# el rango de fechas se leen de las APIs del servidor, donde debe existir el
+# usuario bench/bench (o el que indique USUARIO).
+#
+# El resultado es JSON para poder comparar versiones entre sí.
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.cookiejar import CookieJar
+
+from werkzeug.security import generate_password_hash
+
+from init_db import crear_tablas, migrar
+
+USUARIO = ("bench", "bench")
+
+CUENTAS = [
+    ("1105", "Caja", "activo"),
+    ("1435", "Inventario", "activo"),
+    ("2205", "Proveedores", "pasivo"),
+    ("4135", "Ventas", "ingreso"),
+    ("4175", "Devoluciones en ventas", "ingreso"),
+    ("4199", "Otros ingresos", "ingreso"),
+    ("5195", "Gastos varios", "gasto"),
+    ("6135", "Costo de ventas", "gasto"),
+]
+
+# =========================
+# DATOS SINTÉTICOS
+# =========================
+def generar_datos(db_file, terceros, productos, anios, facturas_dia, compras_dia, semilla=1):
+    """Crea db_file con el esquema de init_db y años de movimientos.
+
+    Las tablas base se llenan directamente y después se aplican las
+    migraciones, que construyen saldos, resúmenes, índice de búsqueda y
+    secuencias a partir de esos datos (igual que en una base existente).
+    """
+    rnd = random.Random(semilla)
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    crear_tablas(c)
+
+    c.execute("INSERT INTO usuarios (usuario, clave, rol, activo) VALUES (?, ?, 'admin', 1)",
+              (USUARIO[0], generate_password_hash(USUARIO[1])))
+    c.executemany("INSERT INTO puc (codigo, nombre, tipo) VALUES (?, ?, ?)", CUENTAS)
+    cuenta = {codigo: id_ for codigo, id_ in c.execute("SELECT codigo, id FROM puc")}
+
+    num_proveedores = max(1, terceros // 10)
+    c.executemany("INSERT INTO terceros (nombres, apellidos, tipo) VALUES (?, ?, ?)",
+                  [(f"Tercero {i}", f"Apellido {i % 97}", "Proveedor" if i <= num_proveedores else "Cliente")
+                   for i in range(1, terceros + 1)])
+    c.executemany("INSERT INTO productos (nombre, descripcion, costo, precio, stock) VALUES (?, ?, ?, ?, ?)",
+                  [(f"Producto {i}", f"Presentación {i % 13}", costo, round(costo * 1.3, 2), 1000000)
+                   for i, costo in ((i, rnd.randint(1, 50) * 100) for i in range(1, productos + 1))])
+    precios = dict(c.execute("SELECT id, precio FROM productos").fetchall())
+
+    hoy = date.today()
+    inicio = hoy - timedelta(days=int(anios * 365))
+    factura_num = 0
+    compra_id = 0
+    dia = inicio
+    while dia <= hoy:
+        fecha = dia.isoformat()
+        facturas, detalle, compras, detalle_c, movimientos = [], [], [], [], []
+        for _ in range(facturas_dia):
+            factura_num += 1
+            lineas = []
+            for pid in rnd.sample(range(1, productos + 1), min(productos, rnd.randint(1, 4))):
+                cantidad = rnd.randint(1, 5)
+                lineas.append((factura_num, pid, cantidad, precios[pid], cantidad * precios[pid]))
+            total = sum(l[4] for l in lineas)
+            facturas.append((factura_num, rnd.randint(num_proveedores + 1, max(num_proveedores + 1, terceros)),
+                             factura_num, fecha, total))
+            detalle.extend(lineas)
+            movimientos += [(fecha, cuenta["1105"], f"Venta factura #{factura_num}", total, 0, "ventas", factura_num),
+                            (fecha, cuenta["4135"], f"Venta factura #{factura_num}", 0, total, "ventas", factura_num)]
+        for _ in range(compras_dia):
+            compra_id += 1
+            pid = rnd.randint(1, productos)
+            cantidad = rnd.randint(10, 100)
+            total = cantidad * precios[pid] * 0.7
+            contado = rnd.random() < 0.5
+            compras.append((compra_id, rnd.randint(1, num_proveedores), str(compra_id), fecha, total,
+                            "contado" if contado else "credito", 1 if contado else 0))
+            detalle_c.append((compra_id, pid, cantidad, precios[pid] * 0.7, total))
+            movimientos += [(fecha, cuenta["1435"], f"Compra #{compra_id}", total, 0, "compras", compra_id),
+                            (fecha, cuenta["1105" if contado else "2205"], f"Compra #{compra_id}", 0, total,
+                             "compras", compra_id)]
+        c.executemany("INSERT INTO facturas (id, tercero_id, numero, fecha, total) VALUES (?, ?, ?, ?, ?)", facturas)
+        c.executemany("INSERT INTO detalle_factura (factura_id, producto_id, cantidad, precio, total) VALUES (?, ?, ?, ?, ?)",
+                      detalle)
+        c.executemany("""INSERT INTO compras (id, tercero_id, numero, fecha, total, forma_pago, pagada)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""", compras)
+        c.executemany("INSERT INTO detalle_compra (compra_id, producto_id, cantidad, costo, total) VALUES (?, ?, ?, ?, ?)",
+                      detalle_c)
+        c.executemany("""INSERT INTO movimientos_contables
+                         (fecha, cuenta_id, descripcion, debito, credito, modulo, referencia_id)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""", movimientos)
+        dia += timedelta(days=1)
+    conn.commit()
+    migrar(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    datos = {tabla: conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+             for tabla in ("terceros", "productos", "facturas", "detalle_factura", "compras", "movimientos_contables")}
+    conn.close()
+    return datos
+
+def contexto_datos(db_file):
+    """Rangos de ids y fechas que usan los escenarios para armar sus peticiones."""
+    conn = sqlite3.connect(db_file)
+    proveedores = [r[0] for r in conn.execute("SELECT id FROM terceros WHERE tipo = 'Proveedor'")]
+    clientes = [r[0] for r in conn.execute("SELECT id FROM terceros WHERE tipo = 'Cliente'")]
+    productos = dict(conn.execute("SELECT id, precio FROM productos").fetchall())
+    desde, hasta = conn.execute("SELECT MIN(fecha), MAX(fecha) FROM facturas").fetchone()
+    conn.close()
+    hoy = date.today().isoformat()
+    return {"proveedores": proveedores or [None], "clientes": clientes or [None], "productos": productos,
+            "desde": date.fromisoformat(desde or hoy), "hasta": date.fromisoformat(hasta or hoy)}
+
+def contexto_servidor(cliente):
+    """Como contexto_datos, pero leído de las APIs del servidor (modo --url)."""
+    def lista(ruta):
+        estado, cuerpo = cliente.get(ruta)
+        if estado != 200 or not isinstance(cuerpo, list):
+            raise RuntimeError(f"{ruta} respondió {estado}: ¿existe el usuario {USUARIO[0]} en el servidor?")
+        return cuerpo
+    proveedores = [t["id"] for t in lista("/api/terceros?tipo=Proveedor")]
+    clientes = [t["id"] for t in lista("/api/terceros?tipo=Cliente")]
+    productos = {p["id"]: p["precio"] or 0 for p in lista("/api/productos")}
+    _, resumen = cliente.post("/api/resumen/ventas", {"fecha_inicio": "0000-00-00", "fecha_fin": "9999-12-31"})
+    dias = [d["dia"] for d in (resumen or {}).get("ventas_diarias") or []]
+    hoy = date.today().isoformat()
+    return {"proveedores": proveedores or [None], "clientes": clientes or [None], "productos": productos,
+            "desde": date.fromisoformat(dias[0] if dias else hoy), "hasta": date.fromisoformat(dias[-1] if dias else hoy)}
+
+# =========================
+# ESCENARIOS
+# =========================
+def _fecha_al_azar(rnd, ctx):
+    return ctx["desde"] + timedelta(days=rnd.randint(0, max(0, (ctx["hasta"] - ctx["desde"]).days)))
+
+def _lineas(rnd, ctx, campo, factor=1.0):
+    pids = rnd.sample(list(ctx["productos"]), min(len(ctx["productos"]), rnd.randint(1, 4)))
+    lineas = []
+    for pid in pids:
+        cantidad = rnd.randint(1, 5)
+        valor = round(ctx["productos"][pid] * factor, 2)
+        lineas.append({"producto_id": pid, "cantidad": cantidad, campo: valor, "total": cantidad * valor})
+    return lineas
+
+def pedido_factura(rnd, ctx):
+    return "/facturacion/save", {"cliente_id": rnd.choice(ctx["clientes"]),
+                                 "fecha": date.today().isoformat(),
+                                 "lines": _lineas(rnd, ctx, "precio")}
+
+def pedido_compra(rnd, ctx):
+    return "/compras/save", {"proveedor_id": rnd.choice(ctx["proveedores"]),
+                             "fecha": date.today().isoformat(),
+                             "forma_pago": rnd.choice(["contado", "credito"]),
+                             "lines": _lineas(rnd, ctx, "costo", 0.7)}
+
+def pedido_balance(rnd, ctx):
+    return "/api/balance", {"fecha_fin": _fecha_al_azar(rnd, ctx).isoformat()}
+
+def pedido_resumen_ventas(rnd, ctx):
+    fin = _fecha_al_azar(rnd, ctx)
+    return "/api/resumen/ventas", {"fecha_inicio": (fin - timedelta(days=30)).isoformat(),
+                                   "fecha_fin": fin.isoformat()}
+
+ESCENARIOS = {
+    "facturacion_save": pedido_factura,
+    "compras_save": pedido_compra,
+    "balance": pedido_balance,
+    "resumen_ventas": pedido_resumen_ventas,
+}
+
+# =========================
+# CLIENTES
+# =========================
+class ClienteTest:
+    """Cliente de pruebas de Flask (sin red; mide app + SQLite)."""
+
+    def __init__(self, app):
+        self.cliente = app.test_client()
+        with self.cliente.session_transaction() as s:
+            s["user"] = USUARIO[0]
+            s["rol"] = "admin"
+
+    def post(self, ruta, datos):
+        r = self.cliente.post(ruta, json=datos)
+        return r.status_code, r.get_json(silent=True)
+
+class ClienteHttp:
+    """Cliente HTTP contra un servidor ya levantado (gunicorn)."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+        datos = urllib.parse.urlencode({"usuario": USUARIO[0], "clave": USUARIO[1]}).encode()
+        self.opener.open(self.url + "/login", datos).read()
+
+    def post(self, ruta, datos):
+        req = urllib.request.Request(self.url + ruta, json.dumps(datos).encode(),
+                                     {"Content-Type": "application/json"})
+        return self._abrir(req)
+
+    def get(self, ruta):
+        return self._abrir(self.url + ruta)
+
+    def _abrir(self, req):
+        try:
+            with self.opener.open(req) as r:
+                return r.status, json.loads(r.read() or b"null")
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+def levantar_gunicorn(db_file, workers, puerto):
+    env = dict(os.environ, POS_DB=os.path.abspath(db_file))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{puerto}",
+                             "app:app"], cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    url = f"http://127.0.0.1:{puerto}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + "/login").read()
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("gunicorn no respondió")
+
+# =========================
+# MEDICIÓN
+# =========================
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    k = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[k]
+
+def medir(nombre, nuevo_cliente, ctx, peticiones, concurrencia, semilla):
+    generador = ESCENARIOS[nombre]
+    tiempos, errores = [], [0]
+    lock = threading.Lock()
+    restantes = iter(range(peticiones))
+
+    def trabajador(n):
+        rnd = random.Random(semilla * 1000 + n)
+        cliente = nuevo_cliente()
+        propios, fallas = [], 0
+        while True:
+            with lock:
+                if next(restantes, None) is None:
+                    break
+            ruta, datos = generador(rnd, ctx)
+            t0 = time.perf_counter()
+            estado, cuerpo = cliente.post(ruta, datos)
+            propios.append(time.perf_counter() - t0)
+            if estado != 200 or (isinstance(cuerpo, dict) and cuerpo.get("success") is False):
+                fallas += 1
+        with lock:
+            tiempos.extend(propios)
+            errores[0] += fallas
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(concurrencia) as ex:
+        list(ex.map(trabajador, range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+    tiempos.sort()
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        "peticiones": len(tiempos),
+        "errores": errores[0],
+        "rps": round(len(tiempos) / duracion, 1) if duracion else None,
+        "p50_ms": ms(percentil(tiempos, 50)),
+        "p95_ms": ms(percentil(tiempos, 95)),
+        "p99_ms": ms(percentil(tiempos, 99)),
+        "max_ms": ms(tiempos[-1] if tiempos else None),
+    }
+
+# =========================
+# PLANES DE LAS LISTAS PAGINADAS
+# =========================
+# (tabla, alias, filtro previo al rango): las listas que pagina _sql_keyset
+LISTAS_PAGINADAS = [
+    ("facturas", "f", ""),
+    ("compras", "c", ""),
+    ("movimientos_contables", "m", ""),
+    ("recibos_caja", "r", ""),
+    ("comprobantes_egreso", "e", ""),
+    ("kardex", "k", "k.producto_id = ? AND "),
+]
+
+def verificar_planes(db_file, limite=200):
+    """Comprueba que las páginas profundas de las listas busquen en el índice.
+
+    Para cada lista toma un cursor a mitad de la tabla y exige que el plan
+    sea un SEARCH por rango de fecha sin B-tree temporal, y que la consulta
+    visite a lo sumo las filas de la página más las del día del cursor (las
+    cuenta una función SQL puesta como primera condición del WHERE). Sin el
+    tope del rango en el cursor visitaría todas las filas más nuevas.
+    Las exportaciones (app.EXPORTACIONES) tampoco deben ordenar en un B-tree
+    temporal. Devuelve {tabla: {"plan", "visitadas", "tope"}} y los planes de
+    exportación en "exportaciones"; lanza AssertionError si alguna no cumple.
+    """
+    from app import EXPORTACIONES, _sql_keyset
+    conn = sqlite3.connect(db_file)
+    visitadas = [0]
+
+    def visita(_):
+        visitadas[0] += 1
+        return 1
+    conn.create_function("_visita", 1, visita)
+    resultado = {}
+    for tabla, alias, filtro in LISTAS_PAGINADAS:
+        previos = []
+        if filtro:
+            fila = conn.execute(f"SELECT producto_id FROM {tabla} GROUP BY producto_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+            if not fila:
+                continue
+            previos = [fila[0]]
+        total = conn.execute(f"SELECT COUNT(*) FROM {tabla} {alias} WHERE {filtro}1=1", previos).fetchone()[0]
+        cursor = conn.execute(f"SELECT fecha, id FROM {tabla} {alias} WHERE {filtro}1=1 ORDER BY fecha DESC, id DESC "
+                              "LIMIT 1 OFFSET ?", previos + [total // 2]).fetchone()
+        if not cursor:
+            continue
+        sql, params = _sql_keyset(f"SELECT {alias}.id FROM {tabla} {alias} "
+                                  f"WHERE _visita({alias}.id) AND {filtro}{alias}.fecha BETWEEN ? AND {{hasta}} {{despues}}",
+                                  previos + ["0000-00-00", "9999-12-31"], alias, tuple(cursor))
+        sql += f" LIMIT {int(limite)}"
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        visitadas[0] = 0
+        conn.execute(sql, params).fetchall()
+        tope = limite + conn.execute(f"SELECT COUNT(*) FROM {tabla} {alias} WHERE {filtro}{alias}.fecha = ?",
+                                     previos + [cursor[0]]).fetchone()[0]
+        resultado[tabla] = {"plan": plan, "visitadas": visitadas[0], "tope": tope}
+        assert any(p.startswith("SEARCH") and "fecha<" in p for p in plan), f"{tabla}: sin rango de fecha: {plan}"
+        assert not any("TEMP B-TREE" in p for p in plan), f"{tabla}: ordena en B-tree temporal: {plan}"
+        assert visitadas[0] <= tope, f"{tabla}: la página visita {visitadas[0]} filas (tope {tope})"
+    resultado["exportaciones"] = {}
+    for tipo, sql in EXPORTACIONES.items():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, ("0000-00-00", "9999-12-31"))]
+        resultado["exportaciones"][tipo] = plan
+        assert not any("TEMP B-TREE" in p for p in plan), f"exportación {tipo}: ordena en B-tree temporal: {plan}"
+    conn.close()
+    return resultado
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark de facturación, compras, balance y resúmenes")
+    p.add_argument("--db", default="bench.db")
+    p.add_argument("--sin-datos", action="store_true", help="usar la base existente sin regenerarla")
+    p.add_argument("--terceros", type=int, default=500)
+    p.add_argument("--productos", type=int, default=300)
+    p.add_argument("--anios", type=float, default=1)
+    p.add_argument("--facturas-dia", type=int, default=50)
+    p.add_argument("--compras-dia", type=int, default=3)
+    p.add_argument("--peticiones", type=int, default=500, help="por escenario")
+    p.add_argument("--concurrencia", type=int, default=4)
+    p.add_argument("--escenarios", default=",".join(ESCENARIOS))
+    p.add_argument("--gunicorn", type=int, default=0, help="levantar gunicorn con N workers")
+    p.add_argument("--puerto", type=int, default=8765)
+    p.add_argument("--url", help="servidor ya levantado (en lugar del cliente de pruebas); no usa --db")
+    p.add_argument("--semilla", type=int, default=1)
+    p.add_argument("--salida", help="archivo JSON de resultados (por defecto, la salida estándar)")
+    args = p.parse_args()
+
+    resultado = {"fecha": datetime.now().isoformat(timespec="seconds"), "config": vars(args).copy()}
+    if not args.url and not args.sin_datos:
+        t0 = time.perf_counter()
+        resultado["datos"] = generar_datos(args.db, args.terceros, args.productos, args.anios,
+                                           args.facturas_dia, args.compras_dia, args.semilla)
+        resultado["datos"]["segundos"] = round(time.perf_counter() - t0, 1)
+    if not args.url:
+        resultado["planes"] = verificar_planes(args.db)
+
+    proc = None
+    if args.url:
+        url = args.url
+    elif args.gunicorn:
+        proc, url = levantar_gunicorn(args.db, args.gunicorn, args.puerto)
+    else:
+        url = None
+        os.environ["POS_DB"] = args.db
+        import app as pos
+        pos.DB_FILE = args.db
+    try:
+        if url:
+            nuevo_cliente = lambda: ClienteHttp(url)
+            resultado["modo"] = f"http {url}"
+        else:
+            nuevo_cliente = lambda: ClienteTest(pos.app)
+            resultado["modo"] = "test_client"
+        # Con --url los ids salen del servidor: los de una base local no existirían allá
+        ctx = contexto_servidor(ClienteHttp(args.url)) if args.url else contexto_datos(args.db)
+        resultado["resultados"] = {
+            nombre: medir(nombre, nuevo_cliente, ctx, args.peticiones, args.concurrencia, args.semilla)
+            for nombre in args.escenarios.split(",") if nombre
+        }
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    salida = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(salida)
+    print(salida)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,8 @@
 import sqlite3
 
-def init_db():
-    conn = sqlite3.connect("pos.db")
-    c = conn.cursor()
+DB_FILE = "pos.db"
 
+def crear_tablas(c):
     # ===========================
     # TERCEROS (Clientes / Proveedores)
     # ===========================
@@ -126,9 +125,587 @@ def init_db():
     )
     """)
 
+    # ===========================
+    # NOTAS CRÉDITO
+    # ===========================
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS notas_credito (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        factura_id INTEGER NOT NULL,
+        numero INTEGER NOT NULL,
+        fecha TEXT NOT NULL,
+        tercero_id INTEGER,
+        motivo TEXT,
+        total REAL NOT NULL,
+        creado_por TEXT,
+        FOREIGN KEY (factura_id) REFERENCES facturas(id),
+        FOREIGN KEY (tercero_id) REFERENCES terceros(id)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS detalle_nota_credito (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nota_id INTEGER NOT NULL,
+        producto_id INTEGER NOT NULL,
+        descripcion TEXT,
+        cantidad REAL NOT NULL,
+        precio REAL NOT NULL,
+        total REAL NOT NULL,
+        FOREIGN KEY (nota_id) REFERENCES notas_credito(id),
+        FOREIGN KEY (producto_id) REFERENCES productos(id)
+    )
+    """)
+
+    # ===========================
+    # RECIBOS DE CAJA / COMPROBANTES DE EGRESO
+    # ===========================
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS recibos_caja (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        numero INTEGER NOT NULL,
+        fecha TEXT NOT NULL,
+        tercero_id INTEGER,
+        concepto TEXT,
+        valor REAL NOT NULL,
+        FOREIGN KEY (tercero_id) REFERENCES terceros(id)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS comprobantes_egreso (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        numero INTEGER NOT NULL,
+        fecha TEXT NOT NULL,
+        tercero_id INTEGER,
+        concepto TEXT,
+        valor REAL NOT NULL,
+        FOREIGN KEY (tercero_id) REFERENCES terceros(id)
+    )
+    """)
+
+    # ===========================
+    # TRANSFORMACIONES DE INVENTARIO
+    # ===========================
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS transformaciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        numero INTEGER NOT NULL,
+        fecha TEXT NOT NULL,
+        descripcion TEXT,
+        total_salida REAL DEFAULT 0,
+        total_entrada REAL DEFAULT 0,
+        creado_por TEXT
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS detalle_transformacion (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        transformacion_id INTEGER NOT NULL,
+        tipo TEXT CHECK(tipo IN ('salida','entrada')) NOT NULL,
+        producto_id INTEGER NOT NULL,
+        cantidad REAL NOT NULL,
+        costo REAL NOT NULL,
+        total REAL NOT NULL,
+        FOREIGN KEY (transformacion_id) REFERENCES transformaciones(id),
+        FOREIGN KEY (producto_id) REFERENCES productos(id)
+    )
+    """)
+
+    # ===========================
+    # USUARIOS
+    # ===========================
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario TEXT UNIQUE NOT NULL,
+        clave TEXT NOT NULL,
+        rol TEXT CHECK(rol IN ('admin','cajero','auxiliar')) NOT NULL DEFAULT 'cajero',
+        activo INTEGER DEFAULT 1
+    )
+    """)
+
+# ===========================
+# MIGRACIONES
+# ===========================
+# (version, [sentencias]). La versión aplicada se guarda en PRAGMA user_version;
+# agregar siempre al final con una versión mayor, nunca editar una ya publicada.
+MIGRACIONES = [
+    (1, [
+        # Rangos de fecha en listas, resúmenes y balance (cubren las columnas agregadas)
+        "CREATE INDEX IF NOT EXISTS idx_facturas_fecha ON facturas(fecha, tercero_id, total, numero)",
+        "CREATE INDEX IF NOT EXISTS idx_compras_fecha ON compras(fecha, tercero_id, total, pagada)",
+        "CREATE INDEX IF NOT EXISTS idx_movimientos_fecha ON movimientos_contables(fecha, cuenta_id)",
+        "CREATE INDEX IF NOT EXISTS idx_movimientos_cuenta ON movimientos_contables(cuenta_id, fecha, debito, credito)",
+        "CREATE INDEX IF NOT EXISTS idx_recibos_caja_fecha ON recibos_caja(fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_comprobantes_egreso_fecha ON comprobantes_egreso(fecha)",
+        # Llaves foráneas usadas para cargar detalles
+        "CREATE INDEX IF NOT EXISTS idx_detalle_factura_factura ON detalle_factura(factura_id)",
+        "CREATE INDEX IF NOT EXISTS idx_detalle_compra_compra ON detalle_compra(compra_id)",
+        "CREATE INDEX IF NOT EXISTS idx_notas_credito_factura ON notas_credito(factura_id)",
+    ]),
+    (2, [
+        # Saldos por cuenta y día: movimientos del día y acumulados hasta ese día
+        """
+        CREATE TABLE IF NOT EXISTS saldos_diarios (
+            cuenta_id INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            debito REAL NOT NULL DEFAULT 0,
+            credito REAL NOT NULL DEFAULT 0,
+            debito_acum REAL NOT NULL DEFAULT 0,
+            credito_acum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (cuenta_id, fecha),
+            FOREIGN KEY (cuenta_id) REFERENCES puc(id)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR REPLACE INTO saldos_diarios (cuenta_id, fecha, debito, credito, debito_acum, credito_acum)
+        SELECT cuenta_id, fecha, debito, credito,
+               SUM(debito) OVER w, SUM(credito) OVER w
+        FROM (SELECT cuenta_id, fecha,
+                     SUM(IFNULL(debito, 0)) AS debito, SUM(IFNULL(credito, 0)) AS credito
+              FROM movimientos_contables GROUP BY cuenta_id, fecha)
+        WINDOW w AS (PARTITION BY cuenta_id ORDER BY fecha)
+        """,
+    ]),
+    (3, [
+        # Resúmenes diarios de ventas (netos de notas crédito) y compras
+        """
+        CREATE TABLE IF NOT EXISTS resumen_ventas_dia (
+            fecha TEXT PRIMARY KEY,
+            num_documentos INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resumen_ventas_producto (
+            fecha TEXT NOT NULL,
+            producto_id INTEGER NOT NULL,
+            cantidad REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            num_documentos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, producto_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resumen_ventas_tercero (
+            fecha TEXT NOT NULL,
+            tercero_id INTEGER NOT NULL,
+            num_documentos INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, tercero_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resumen_compras_dia (
+            fecha TEXT PRIMARY KEY,
+            num_documentos INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            pagadas REAL NOT NULL DEFAULT 0,
+            pendientes REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resumen_compras_producto (
+            fecha TEXT NOT NULL,
+            producto_id INTEGER NOT NULL,
+            cantidad REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            num_documentos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, producto_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resumen_compras_tercero (
+            fecha TEXT NOT NULL,
+            tercero_id INTEGER NOT NULL,
+            num_documentos INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, tercero_id)
+        ) WITHOUT ROWID
+        """,
+        # Carga inicial desde los documentos existentes
+        """
+        INSERT INTO resumen_ventas_dia (fecha, num_documentos, total)
+        SELECT DATE(fecha), COUNT(*), SUM(total) FROM facturas
+        WHERE DATE(fecha) IS NOT NULL GROUP BY DATE(fecha)
+        """,
+        """
+        INSERT INTO resumen_ventas_dia (fecha, num_documentos, total)
+        SELECT DATE(fecha), 0, -SUM(total) FROM notas_credito
+        WHERE DATE(fecha) IS NOT NULL GROUP BY DATE(fecha)
+        ON CONFLICT(fecha) DO UPDATE SET total = total + excluded.total
+        """,
+        """
+        INSERT INTO resumen_ventas_producto (fecha, producto_id, cantidad, total, num_documentos)
+        SELECT DATE(f.fecha), df.producto_id, SUM(df.cantidad), SUM(df.total), COUNT(DISTINCT f.id)
+        FROM detalle_factura df JOIN facturas f ON df.factura_id = f.id
+        WHERE DATE(f.fecha) IS NOT NULL GROUP BY DATE(f.fecha), df.producto_id
+        """,
+        """
+        INSERT INTO resumen_ventas_producto (fecha, producto_id, cantidad, total, num_documentos)
+        SELECT DATE(nc.fecha), d.producto_id, -SUM(d.cantidad), -SUM(d.total), 0
+        FROM detalle_nota_credito d JOIN notas_credito nc ON d.nota_id = nc.id
+        WHERE DATE(nc.fecha) IS NOT NULL GROUP BY DATE(nc.fecha), d.producto_id
+        ON CONFLICT(fecha, producto_id) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad, total = total + excluded.total
+        """,
+        """
+        INSERT INTO resumen_ventas_tercero (fecha, tercero_id, num_documentos, total)
+        SELECT DATE(fecha), tercero_id, COUNT(*), SUM(total) FROM facturas
+        WHERE DATE(fecha) IS NOT NULL AND tercero_id IS NOT NULL GROUP BY DATE(fecha), tercero_id
+        """,
+        """
+        INSERT INTO resumen_ventas_tercero (fecha, tercero_id, num_documentos, total)
+        SELECT DATE(fecha), tercero_id, 0, -SUM(total) FROM notas_credito
+        WHERE DATE(fecha) IS NOT NULL AND tercero_id IS NOT NULL GROUP BY DATE(fecha), tercero_id
+        ON CONFLICT(fecha, tercero_id) DO UPDATE SET total = total + excluded.total
+        """,
+        """
+        INSERT INTO resumen_compras_dia (fecha, num_documentos, total, pagadas, pendientes)
+        SELECT DATE(fecha), COUNT(*), SUM(total),
+               SUM(CASE WHEN pagada = 1 THEN total ELSE 0 END),
+               SUM(CASE WHEN pagada = 0 THEN total ELSE 0 END)
+        FROM compras WHERE DATE(fecha) IS NOT NULL GROUP BY DATE(fecha)
+        """,
+        """
+        INSERT INTO resumen_compras_producto (fecha, producto_id, cantidad, total, num_documentos)
+        SELECT DATE(c.fecha), dc.producto_id, SUM(dc.cantidad), SUM(dc.total), COUNT(DISTINCT c.id)
+        FROM detalle_compra dc JOIN compras c ON dc.compra_id = c.id
+        WHERE DATE(c.fecha) IS NOT NULL GROUP BY DATE(c.fecha), dc.producto_id
+        """,
+        """
+        INSERT INTO resumen_compras_tercero (fecha, tercero_id, num_documentos, total)
+        SELECT DATE(fecha), tercero_id, COUNT(*), SUM(total) FROM compras
+        WHERE DATE(fecha) IS NOT NULL AND tercero_id IS NOT NULL GROUP BY DATE(fecha), tercero_id
+        """,
+    ]),
+    (4, [
+        # Búsqueda de productos por palabras/prefijos (FTS5 sobre nombre y descripción)
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS productos_fts USING fts5(
+            nombre, descripcion,
+            content='productos', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_fts_ai AFTER INSERT ON productos BEGIN
+            INSERT INTO productos_fts(rowid, nombre, descripcion) VALUES (new.id, new.nombre, new.descripcion);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_fts_ad AFTER DELETE ON productos BEGIN
+            INSERT INTO productos_fts(productos_fts, rowid, nombre, descripcion)
+            VALUES ('delete', old.id, old.nombre, old.descripcion);
+        END
+        """,
+        # Solo cambios de nombre/descripción: los movimientos de stock no tocan el índice
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_fts_au AFTER UPDATE OF nombre, descripcion ON productos BEGIN
+            INSERT INTO productos_fts(productos_fts, rowid, nombre, descripcion)
+            VALUES ('delete', old.id, old.nombre, old.descripcion);
+            INSERT INTO productos_fts(rowid, nombre, descripcion) VALUES (new.id, new.nombre, new.descripcion);
+        END
+        """,
+        "INSERT INTO productos_fts(productos_fts) VALUES ('rebuild')",
+        "CREATE INDEX IF NOT EXISTS idx_productos_nombre ON productos(nombre)",
+    ]),
+    (5, [
+        # Versión de cada catálogo; sube con cada escritura para invalidar cachés y ETags
+        """
+        CREATE TABLE IF NOT EXISTS versiones_catalogo (
+            nombre TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        "INSERT OR IGNORE INTO versiones_catalogo (nombre) VALUES ('productos'), ('puc'), ('terceros')",
+    ]),
+    (6, [
+        # Consecutivos por tipo de documento: último número entregado
+        """
+        CREATE TABLE IF NOT EXISTS secuencias (
+            nombre TEXT PRIMARY KEY,
+            ultimo INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR IGNORE INTO secuencias (nombre, ultimo)
+        SELECT 'facturas', IFNULL(MAX(numero), 0) FROM facturas
+        UNION ALL SELECT 'notas_credito', IFNULL(MAX(numero), 0) FROM notas_credito
+        UNION ALL SELECT 'compras', MAX(IFNULL((SELECT MAX(id) FROM compras), 0),
+                                        IFNULL((SELECT MAX(CAST(numero AS INTEGER)) FROM compras), 0))
+        UNION ALL SELECT 'recibos_caja', IFNULL(MAX(numero), 0) FROM recibos_caja
+        UNION ALL SELECT 'comprobantes_egreso', IFNULL(MAX(numero), 0) FROM comprobantes_egreso
+        UNION ALL SELECT 'transformaciones', IFNULL(MAX(numero), 0) FROM transformaciones
+        """,
+    ]),
+    (7, [
+        # Cola de asientos por contabilizar (modo de contabilidad diferida)
+        """
+        CREATE TABLE IF NOT EXISTS asientos_pendientes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            modulo TEXT NOT NULL,
+            referencia_id INTEGER NOT NULL,
+            datos TEXT NOT NULL,
+            intentos INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            creado TEXT NOT NULL DEFAULT (datetime('now')),
+            proximo_intento TEXT NOT NULL DEFAULT (datetime('now')),
+            UNIQUE (modulo, referencia_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_movimientos_referencia ON movimientos_contables(modulo, referencia_id)",
+    ]),
+    (8, [
+        # Kardex con costo promedio ponderado: una fila por movimiento de inventario
+        # con los saldos corridos del producto después del movimiento
+        """
+        CREATE TABLE IF NOT EXISTS kardex (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            producto_id INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            documento_id INTEGER,
+            cantidad REAL NOT NULL,
+            costo_unitario REAL NOT NULL,
+            valor REAL NOT NULL,
+            saldo_cantidad REAL NOT NULL,
+            saldo_valor REAL NOT NULL,
+            costo_promedio REAL NOT NULL,
+            FOREIGN KEY (producto_id) REFERENCES productos(id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_kardex_producto ON kardex(producto_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_kardex_documento ON kardex(tipo, documento_id)",
+        # Saldo inicial: el stock y el último costo conocidos pasan a ser el punto de partida
+        """
+        INSERT INTO kardex (producto_id, fecha, tipo, cantidad, costo_unitario, valor,
+                            saldo_cantidad, saldo_valor, costo_promedio)
+        SELECT id, date('now'), 'inicial', stock, IFNULL(costo, 0), stock * IFNULL(costo, 0),
+               stock, stock * IFNULL(costo, 0), IFNULL(costo, 0)
+        FROM productos
+        """,
+    ]),
+    (9, [
+        # Existencias por producto y día (movimiento del día y acumulado), para
+        # consultar el inventario a una fecha con una búsqueda por producto
+        """
+        CREATE TABLE IF NOT EXISTS existencias_diarias (
+            producto_id INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            cantidad REAL NOT NULL DEFAULT 0,
+            valor REAL NOT NULL DEFAULT 0,
+            cantidad_acum REAL NOT NULL DEFAULT 0,
+            valor_acum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (producto_id, fecha)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR REPLACE INTO existencias_diarias (producto_id, fecha, cantidad, valor, cantidad_acum, valor_acum)
+        SELECT producto_id, fecha, cantidad, valor, SUM(cantidad) OVER w, SUM(valor) OVER w
+        FROM (SELECT producto_id, fecha, SUM(cantidad) AS cantidad, SUM(valor) AS valor
+              FROM kardex GROUP BY producto_id, fecha)
+        WINDOW w AS (PARTITION BY producto_id ORDER BY fecha)
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_kardex_fecha ON kardex(producto_id, fecha, id)",
+    ]),
+    (10, [
+        # Búsqueda de terceros por su clave natural (importación masiva)
+        "CREATE INDEX IF NOT EXISTS idx_terceros_nombres ON terceros(nombres, apellidos, tipo)",
+    ]),
+    (11, [
+        # Clave generada por la caja para cada venta (cola sin conexión):
+        # una factura sincronizada dos veces se reconoce por ella
+        "ALTER TABLE facturas ADD COLUMN clave TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_facturas_clave ON facturas(clave) WHERE clave IS NOT NULL",
+    ]),
+    (12, [
+        # Idempotency-Key de los guardados de documentos, con la respuesta que se devolvió
+        """
+        CREATE TABLE IF NOT EXISTS claves_idempotencia (
+            clave TEXT PRIMARY KEY,
+            ruta TEXT NOT NULL,
+            usuario TEXT,
+            status INTEGER NOT NULL,
+            respuesta TEXT NOT NULL,
+            creado TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_claves_idempotencia_creado ON claves_idempotencia(creado)",
+    ]),
+    (13, [
+        # Concurrencia optimista: cada escritura del producto sube su versión
+        "ALTER TABLE productos ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (14, [
+        # Punto de reorden: alertas_stock guarda los productos con stock <= stock_minimo.
+        # Los triggers la mantienen al día desde cualquier escritura de productos
+        # (ventas, compras, notas, transformaciones, ajustes, importación).
+        "ALTER TABLE productos ADD COLUMN stock_minimo REAL NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS alertas_stock (
+            producto_id INTEGER PRIMARY KEY,
+            stock REAL NOT NULL,
+            stock_minimo REAL NOT NULL,
+            desde TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_alerta_ai AFTER INSERT ON productos
+        WHEN new.stock <= new.stock_minimo BEGIN
+            INSERT OR REPLACE INTO alertas_stock (producto_id, stock, stock_minimo)
+            VALUES (new.id, new.stock, new.stock_minimo);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_alerta_au AFTER UPDATE OF stock, stock_minimo ON productos
+        WHEN new.stock <= new.stock_minimo BEGIN
+            INSERT INTO alertas_stock (producto_id, stock, stock_minimo)
+            VALUES (new.id, new.stock, new.stock_minimo)
+            ON CONFLICT(producto_id) DO UPDATE SET stock = excluded.stock, stock_minimo = excluded.stock_minimo;
+        END
+        """,
+        # Solo borra al cruzar el mínimo hacia arriba: una venta normal no escribe en alertas_stock
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_alerta_fin AFTER UPDATE OF stock, stock_minimo ON productos
+        WHEN new.stock > new.stock_minimo AND old.stock <= old.stock_minimo BEGIN
+            DELETE FROM alertas_stock WHERE producto_id = new.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS productos_alerta_ad AFTER DELETE ON productos BEGIN
+            DELETE FROM alertas_stock WHERE producto_id = old.id;
+        END
+        """,
+        """
+        INSERT OR REPLACE INTO alertas_stock (producto_id, stock, stock_minimo)
+        SELECT id, stock, stock_minimo FROM productos WHERE stock <= stock_minimo
+        """,
+    ]),
+    (15, [
+        # Sesiones de caja: cada documento suma a los totales de la sesión abierta
+        # del usuario en su misma transacción; el cierre es la lectura de una fila
+        """
+        CREATE TABLE IF NOT EXISTS sesiones_caja (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario TEXT NOT NULL,
+            abierta TEXT NOT NULL DEFAULT (datetime('now')),
+            cerrada TEXT,
+            base REAL NOT NULL DEFAULT 0,
+            ventas REAL NOT NULL DEFAULT 0,
+            num_ventas INTEGER NOT NULL DEFAULT 0,
+            recibos REAL NOT NULL DEFAULT 0,
+            num_recibos INTEGER NOT NULL DEFAULT 0,
+            egresos REAL NOT NULL DEFAULT 0,
+            num_egresos INTEGER NOT NULL DEFAULT 0,
+            devoluciones REAL NOT NULL DEFAULT 0,
+            num_devoluciones INTEGER NOT NULL DEFAULT 0,
+            compras_contado REAL NOT NULL DEFAULT 0,
+            num_compras_contado INTEGER NOT NULL DEFAULT 0,
+            esperado REAL,
+            contado REAL,
+            diferencia REAL,
+            observaciones TEXT
+        )
+        """,
+        # Una sola sesión abierta por usuario; es también la búsqueda de cada documento
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_sesiones_caja_abierta ON sesiones_caja(usuario) WHERE cerrada IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_sesiones_caja_usuario ON sesiones_caja(usuario, abierta)",
+    ]),
+    (16, [
+        # Idempotency-Key por usuario y con la huella del cuerpo: la misma clave
+        # de otro usuario no repite su respuesta, y con otro cuerpo se rechaza.
+        # Es una caché de 24 h, así que se recrea en vez de copiarla
+        "DROP TABLE IF EXISTS claves_idempotencia",
+        """
+        CREATE TABLE claves_idempotencia (
+            clave TEXT NOT NULL,
+            usuario TEXT NOT NULL,
+            ruta TEXT NOT NULL,
+            huella TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            respuesta TEXT NOT NULL,
+            creado TEXT NOT NULL DEFAULT (datetime('now')),
+            PRIMARY KEY (clave, usuario)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_claves_idempotencia_creado ON claves_idempotencia(creado)",
+    ]),
+    (17, [
+        # Orden (fecha, id) de las listas paginadas y las exportaciones: los índices
+        # por fecha de la migración 1 siguen con otras columnas antes del id y
+        # obligaban a ordenar cada día en un B-tree temporal
+        "CREATE INDEX IF NOT EXISTS idx_facturas_fecha_id ON facturas(fecha, id)",
+        "CREATE INDEX IF NOT EXISTS idx_compras_fecha_id ON compras(fecha, id)",
+        "CREATE INDEX IF NOT EXISTS idx_movimientos_fecha_id ON movimientos_contables(fecha, id)",
+    ]),
+    (18, [
+        # Parámetros del sistema (nombre -> valor)
+        """
+        CREATE TABLE IF NOT EXISTS parametros (
+            nombre TEXT PRIMARY KEY,
+            valor TEXT
+        ) WITHOUT ROWID
+        """,
+        # Desde cuándo el kardex tiene la historia completa. En una base que ya
+        # tenía documentos, la migración 8 partió del stock de ese día (fila
+        # 'inicial') y no reconstruyó los movimientos anteriores; sin documentos
+        # previos no hay fecha y el kardex cubre todo
+        """
+        INSERT OR IGNORE INTO parametros (nombre, valor)
+        SELECT 'kardex_desde', k.fecha
+        FROM (SELECT fecha FROM kardex WHERE tipo = 'inicial' AND documento_id IS NULL ORDER BY id LIMIT 1) k
+        WHERE EXISTS (SELECT 1 FROM facturas WHERE fecha < k.fecha)
+           OR EXISTS (SELECT 1 FROM compras WHERE fecha < k.fecha)
+           OR EXISTS (SELECT 1 FROM notas_credito WHERE fecha < k.fecha)
+           OR EXISTS (SELECT 1 FROM transformaciones WHERE fecha < k.fecha)
+        """,
+    ]),
+]
+
+def version_esquema(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrar(conn):
+    """Aplica en orden las migraciones pendientes, cada una en su transacción.
+
+    Varios workers pueden arrancar a la vez: la versión se vuelve a leer
+    con el lock de escritura tomado antes de aplicar cada migración.
+    """
+    aplicadas = 0
+    for version, sentencias in MIGRACIONES:
+        if version_esquema(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version_esquema(conn) >= version:
+                conn.rollback()
+                continue
+            for sql in sentencias:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas += 1
+    if aplicadas:
+        conn.execute("ANALYZE")
+        conn.commit()
+    return aplicadas
+
+def preparar_esquema(conn):
+    """Crea las tablas que falten y aplica las migraciones pendientes."""
+    crear_tablas(conn.cursor())
     conn.commit()
+    return migrar(conn)
+
+def init_db(db_file=DB_FILE):
+    conn = sqlite3.connect(db_file)
+    aplicadas = preparar_esquema(conn)
+    version = version_esquema(conn)
     conn.close()
-    print("✅ Base de datos inicializada en pos.db con la tabla 'terceros'.")
+    print(f"✅ Base de datos inicializada en {db_file} (esquema v{version}, {aplicadas} migraciones aplicadas).")
 
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,67 @@
+/* Utilidades compartidas de las vistas */
+
+// Pide una lista en formato NDJSON y llama onFila(registro) a medida que
+// llegan las líneas, sin esperar a que el servidor arme toda la respuesta.
+async function leerNdjson(url, body, onFila) {
+    const res = await fetch(url, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json', 'Accept': 'application/x-ndjson'},
+        body: JSON.stringify(Object.assign({}, body, {formato: 'ndjson'}))
+    });
+    if (!(res.headers.get('Content-Type') || '').startsWith('application/x-ndjson')) {
+        const data = await res.json();
+        throw new Error(data.error || 'Respuesta inválida');
+    }
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const {value, done} = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, {stream: true});
+        let i;
+        while ((i = buffer.indexOf('\n')) >= 0) {
+            const linea = buffer.slice(0, i).trim();
+            buffer = buffer.slice(i + 1);
+            if (linea) onFila(JSON.parse(linea));
+        }
+    }
+    if (buffer.trim()) onFila(JSON.parse(buffer));
+}
+
+// Conecta un campo de búsqueda con un <select> de productos: a medida que
+// se escribe consulta /api/productos/search y reemplaza las opciones.
+// opcion(p) debe devolver el <option> para cada producto.
+function buscadorProductos(input, select, opcion, limite) {
+    let timer = null;
+    let secuencia = 0;
+    async function buscar() {
+        const actual = ++secuencia;
+        const url = '/api/productos/search?q=' + encodeURIComponent(input.value.trim())
+                  + '&limit=' + (limite || 20);
+        const data = await (await fetch(url)).json();
+        if (actual !== secuencia || !data.success) return;  // llegó una respuesta más nueva
+        const vacia = select.options[0];
+        select.innerHTML = '';
+        select.appendChild(vacia);
+        data.productos.forEach(p => select.appendChild(opcion(p)));
+        if (data.productos.length === 1 && input.value.trim()) {
+            select.selectedIndex = 1;
+            select.dispatchEvent(new Event('change'));
+        }
+    }
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(buscar, 200);
+    });
+    buscar();
+    return buscar;
+}
+
+// Clave Idempotency-Key para guardar un documento. Las vistas generan una al
+// cargar y la reenvían en cada intento: si el primero sí se guardó (doble
+// clic, error de red), el servidor devuelve la misma respuesta sin duplicarlo.
+function nuevaClaveIdempotencia() {
+    return crypto.randomUUID ? crypto.randomUUID()
+                             : Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+}